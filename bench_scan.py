@@ -0,0 +1,107 @@
+"""
+Benchmarks the HandBrake CLI title scans BrakeJob does for every disc of a
+source directory. Each disc is scanned with HandBrake's default (full) scan and
+with the reduced scan BrakeJob uses when filtering TV episodes or movies, and
+the time spent on both is compared.
+
+When the HandBrake CLI can output the scan as JSON, the time BrakeJob spends
+parsing the JSON title set is also compared to parsing the log text.
+
+Example Usage:
+python bench_scan.py --source-dir "C:\\Users\\Jeff\\Documents\\DVDFab\\FullDisc" --repeat 3
+"""
+# Copyright 2010, Jeffrey Parker (jeffreyparker@gmail.com)
+#
+# GPLv2 License, see brakejob.py
+
+import optparse
+import time
+
+import brakejob
+from brakejob import logger
+
+USAGE = "%prog --source-dir <dir> [--handbrake-path <path>] [--repeat <n>] [--parse-repeat <n>] [--min-duration <sec>]"
+
+def parse_options():
+    p = optparse.OptionParser(usage = USAGE)
+    p.add_option('--source-dir', metavar='<dir>', help="Source directory to scan")
+    p.add_option('--handbrake-path', metavar='<path>', help="Path to HandBrake CLI executable")
+    p.add_option('--repeat', default = 1, type='int', metavar='<n>', help="Number of times to scan each disc")
+    p.add_option('--parse-repeat', default = 20, type='int', metavar='<n>', help="Number of times to parse each scan output")
+    p.add_option('--min-duration', type='int', metavar='<sec>', help="Minimum title duration of the reduced scan")
+    options, arguments = p.parse_args()
+    if not options.source_dir:
+        p.print_help()
+        p.error("--source-dir is required")
+    return options
+
+# Best of 'repeat' scans, as (seconds, number of titles)
+def time_scan(handbrake, source, scan_options, repeat):
+    best = None
+    titles = 0
+    for i in range(repeat):
+        start = time.time()
+        disc = handbrake.get_disc_info(source, scan_options)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        if disc:
+            titles = len(disc.titles)
+    return (best, titles)
+
+# Best time of 'repeat' parses of the same output, in milliseconds
+def time_parse(parse, output, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        parse(output)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def compare_parsers(handbrake, sources, repeat):
+    text_total = 0.0
+    json_total = 0.0
+    for source in sources:
+        title_options = {'title':0, 'input':source}
+        text_output = handbrake.call(dict_options = title_options, ignore_output = False)
+        json_output = handbrake.call(dict_options = title_options, raw_options = ['--json', '--scan'], ignore_output = False)
+        text_time = time_parse(handbrake.parse_scan_text, text_output, repeat)
+        json_time = time_parse(handbrake.parse_scan_json, json_output, repeat)
+        text_total += text_time
+        json_total += json_time
+        logger.info("%s\n  text: %.2f ms, json: %.2f ms" %(source, text_time, json_time))
+    logger.info("\nTotal parsing: text %.2f ms, json %.2f ms" %(text_total, json_total))
+
+def main():
+    options = parse_options()
+    handbrake = brakejob.Handbrake(brakejob.get_handbrake_path(options.handbrake_path))
+    settings = {'min_duration': options.min_duration, 'tv_detection': True, \
+                'movie_detection': False, 'auto_detection': False}
+    scan_options = brakejob.calc_scan_options(handbrake, settings)
+    logger.info("Reduced scan options: %s\n" %scan_options)
+
+    full_total = 0.0
+    reduced_total = 0.0
+    sources = brakejob.find_sources(options.source_dir)
+    for source in sources:
+        (full, full_titles) = time_scan(handbrake, source, None, options.repeat)
+        (reduced, reduced_titles) = time_scan(handbrake, source, scan_options, options.repeat)
+        full_total += full
+        reduced_total += reduced
+        logger.info("%s\n  full: %.2f sec (%d titles), reduced: %.2f sec (%d titles)" \
+            %(source, full, full_titles, reduced, reduced_titles))
+
+    if full_total > 0:
+        logger.info("\nTotal: full %.2f sec, reduced %.2f sec (%.0f%% less scan time)" \
+            %(full_total, reduced_total, 100 * (full_total - reduced_total) / full_total))
+
+    if handbrake.supports('--json'):
+        logger.info("\nParsing the scan output:\n")
+        compare_parsers(handbrake, sources, options.parse_repeat)
+    else:
+        logger.info("\nThis HandBrake CLI can't output the scan as JSON, skipping the parser comparison")
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,13 @@ python brakejob.py --source-dir "C:\Users\Jeff\Documents\DVDFab\FullDisc" --hand
 * Encode a directory using the Normal preset, but also add detelecine and decomb, using mkv container,
 burn-in any foreign subs and include the English langauge soft-subs (toggleable on/off)
 python brakejob.py --source-dir "C:\Users\Jeff\Documents\DVDFab\FullDisc" --native-lang eng --burn-foreign-subs --sub-langs eng --extension mkv --handbrake-args "-Z Normal -f mkv --detelecine --decomb" --encode
+
+* List the discs scanned so far that have no English subtitle track, without
+scanning anything again:
+python brakejob.py query missing-subs eng
+
+* Spread the encodes over two drives, keeping all discs of a show on the same one:
+python brakejob.py --source-dir "C:\Users\Jeff\Documents\DVDFab\FullDisc" --output-dir D:\Video --output-dir E:\Video --placement show --encode
 """
 # Copyright 2010, Jeffrey Parker (jeffreyparker@gmail.com)
 #
@@ -44,19 +51,40 @@ python brakejob.py --source-dir "C:\Users\Jeff\Documents\DVDFab\FullDisc" --nati
 #
 #  http://www.opensource.org/licenses/gpl-2.0.php
 
+import array
+import base64
 import copy
+import cProfile
+from cStringIO import StringIO
+import gc
+import hashlib
+import json
 import logging
+import math
 import operator
 import optparse
 import os
 import platform
 from pprint import pprint, pformat
+import pstats
+import Queue
+import re
 import shlex
+import shutil
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where we just don't report the peak memory use
+    resource = None
 
-from pyparsing import alphas,nums, dblQuotedString, Combine, Word, Group, Dict, delimitedList, Suppress, removeQuotes, Literal, restOfLine, ZeroOrMore, SkipTo, ParserElement
+from pyparsing import alphas,nums, dblQuotedString, Combine, Word, Group, Dict, delimitedList, Suppress, removeQuotes, Literal, restOfLine, ZeroOrMore, SkipTo, ParserElement, Optional
 
 logger = logging.getLogger("logger")
 logger.setLevel(logging.INFO)
@@ -66,41 +94,553 @@ logger.addHandler(ch)
 VALID_FILES = ['.iso']
 VALID_FOLDER_FILES = ['.ifo','.vob']
 DEFAULT_THRESHOLD = 0.10
+MIN_EPISODE_LENGTH = 10 * 60
+MAX_EPISODE_LENGTH = 75 * 60
+# Menus, logos and the like. Shorter than any episode worth encoding.
+MIN_TITLE_LENGTH = 60
 DEFAULT_LANG = 'eng'
 DEFAULT_HB = os.path.join(os.getcwd(),'HandBrakeCLI.exe')
 DEFAULT_VERBOSITY = '0'
 DEFAULT_FORMAT = 'mp4'
+SAMPLE_COUNT = 8
+SAMPLE_SIZE = 64 * 1024
+ISO_SECTOR = 2048
+SCAN_PREVIEWS = '1:0'
+DEFAULT_SCAN_JOBS = 1
+DEFAULT_DEVICE_JOBS = 1
+DEFAULT_STAGE_BUDGET = 20
+STAGE_SUBDIR = 'brakejob-stage'
+TEMP_SUBDIR = 'brakejob-encodes'
+MOVE_BACKLOG = 2
+KILL_TIMEOUT = 5
+DEFAULT_SCAN_TIMEOUT = 20 * 60
+DEFAULT_STALL_TIMEOUT = 10 * 60
+DEFAULT_RETRIES = 1
+# When none of AAC_ENCODERS shows up in the help, what current builds have
+DEFAULT_AUDIO_ENCODER = 'av_aac'
+# Newest first, the first one the HandBrake CLI has is used
+AAC_ENCODERS = ['av_aac', 'ca_aac', 'faac', 'ffaac']
+AUDIO_ENCODERS = AAC_ENCODERS + ['copy:ac3', 'copy:dts', 'copy:aac', 'copy:mp3', 'ac3', 'lame', 'mp3', 'vorbis', 'flac']
+JSON_TITLE_SET = 'JSON Title Set:'
+# The JSON scan names channel layouts, the text scan counts channels
+JSON_CHANNEL_LAYOUTS = {'mono': '1.0', 'stereo': '2.0', 'dpl1': '2.0', 'dpl2': '2.0'}
+PLAN_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.brakejob')
+HANDBRAKE_CACHE = 'handbrake.json'
+CATALOG_FILE = 'catalog.json'
+CATALOG_VERSION = 1
+JOURNAL_FILE = 'journal.json'
+PLACEMENT_FILE = 'placement.json'
+PLACEMENT_POLICIES = ['round-robin', 'free-space', 'show']
+DEFAULT_PLACEMENT = 'round-robin'
+# What an encode is guessed to take per second of video (2 Mbit/s), to spread a
+# batch by free space before any of it is written
+ENCODE_BYTES_PER_SECOND = 250000
+# A season or disc number at the end of a disc's name, e.g. the 'D2' of 'Show S1 D2'
+SHOW_SUFFIX = re.compile(r'(season|disc|disk|s|d)?\s*\d+$', re.IGNORECASE)
+# Audio codecs (as named by the scan) each container can take without re-encoding
+PASSTHRU_CODECS = {'mp4': ['AC3', 'AAC'], \
+                   'm4v': ['AC3', 'AAC'], \
+                   'mkv': ['AC3', 'DTS', 'AAC', 'MP3'], \
+}
 VERSION = '0.1.2'
 USAGE = "%prog --source-dir <dir> [--handbrake-args <\"args\">] [--encode] [other options]"
+QUERY_USAGE = "%prog query <question> [<lang>] [--cache-dir <dir>] [--json]\n\n" \
+    +"Answers questions about every disc scanned so far, without scanning anything:\n" \
+    +"  summary             number of discs and titles, and their runtime\n" \
+    +"  missing-subs <lang> discs without a <lang> subtitle track\n" \
+    +"  missing-audio <lang> discs without a <lang> audio track\n" \
+    +"  unencoded           selected titles that haven't been encoded yet, and their runtime"
+
+class ProcessResult():
+
+    returncode = None
+    output = None
+    timed_out = False
+    stalled = False
+    cancelled = False
+
+    def __init__(self, returncode, output, timed_out, cancelled):
+        self.returncode = returncode
+        self.output = output
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+
+# Starts and keeps track of all child processes, so several of them can run at
+# once (from different threads), their output can be followed while they run,
+# and none of them are left behind when brakejob stops.
+class ProcessSupervisor():
+
+    def __init__(self):
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.cancelled = False
+        # Where the processes' own output (e.g. HandBrake's progress) goes,
+        # when it isn't captured
+        self.output = sys.stdout
+
+    # Runs 'call' to completion and returns a ProcessResult.
+    # capture: collect stdout+stderr (instead of letting it go to the console)
+    # watch: gets each line of the log (stderr, or all output when capturing)
+    # timeout: seconds before the process is killed
+    # progress: a ProgressMonitor that gets each line of stdout, the process is
+    # killed when it reports no progress for 'stall_timeout' seconds
+    def run(self, call, capture = False, watch = None, timeout = None, progress = None, stall_timeout = None):
+        stdout = None
+        stderr = None
+        if capture:
+            stdout = subprocess.PIPE
+            stderr = subprocess.STDOUT
+        else:
+            if watch:
+                stderr = subprocess.PIPE
+            if progress or self.output is not sys.stdout:
+                stdout = subprocess.PIPE
+        with self.lock:
+            if self.cancelled:
+                return ProcessResult(None, '', False, True)
+            p = subprocess.Popen(call, stdout = stdout, stderr = stderr)
+            self.processes.add(p)
+
+        started = time.time()
+        if progress:
+            progress.reset()
+        timed_out = False
+        stalled = False
+        chunks = []
+        readers = []
+        try:
+            if capture:
+                readers.append(self._reader(p.stdout, None, watch, chunks))
+            else:
+                if watch:
+                    readers.append(self._reader(p.stderr, sys.stderr, watch, None))
+                if stdout:
+                    readers.append(self._reader(p.stdout, self.output, progress and progress.watch, None))
+            # Poll instead of wait() so Ctrl-C still gets through
+            while p.poll() is None or [r for r in readers if r.isAlive()]:
+                if p.poll() is None:
+                    if timeout and time.time() - started > timeout:
+                        timed_out = True
+                        self._stop(p)
+                    elif progress and stall_timeout and progress.idle() > stall_timeout:
+                        stalled = True
+                        self._stop(p)
+                time.sleep(0.1)
+        finally:
+            with self.lock:
+                self.processes.discard(p)
+        result = ProcessResult(p.returncode, ''.join(chunks), timed_out, self.cancelled)
+        result.stalled = stalled
+        return result
+
+    # Reads a pipe until it closes, in a separate thread so the caller stays
+    # responsive to Ctrl-C. Progress updates end in '\r' rather than '\n', so
+    # both count as the end of a line.
+    def _reader(self, stream, echo, watch, chunks):
+        def read():
+            pending = ''
+            while True:
+                data = os.read(stream.fileno(), 4096)
+                if not data:
+                    break
+                if chunks is not None:
+                    chunks.append(data)
+                if echo:
+                    echo.write(data)
+                    echo.flush()
+                if watch:
+                    lines = re.split(r'[\r\n]', pending + data)
+                    pending = lines.pop()
+                    for line in lines:
+                        if line:
+                            watch(line)
+            if watch and pending:
+                watch(pending)
+        reader = threading.Thread(target = read)
+        reader.daemon = True
+        reader.start()
+        return reader
+
+    def _stop(self, p):
+        try:
+            p.terminate()
+            deadline = time.time() + KILL_TIMEOUT
+            while p.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if p.poll() is None:
+                p.kill()
+        except OSError:
+            # Already gone
+            pass
+
+    # Stops every running process and refuses to start new ones
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+        for p in processes:
+            self._stop(p)
+
+supervisor = ProcessSupervisor()
+
+# Follows HandBrake's progress output to tell when an encode got stuck. Each
+# encode starts with a scan of the source, which counts as progress as well.
+# Also counts how many encodes have started, for a queue with several jobs.
+class ProgressMonitor():
+
+    # e.g. "Encoding: task 1 of 1, 12.34 %" or
+    # "Scanning title 1 of 12, preview 3, 30.00 %"
+    pattern = re.compile(r"(Encoding: task|Scanning title) (\d+) of \d+, (?:preview (\d+), )?([\d.]+) %")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.last_change = time.time()
+        self.jobs = 0
+
+    def watch(self, line):
+        match = self.pattern.search(line)
+        if match and match.groups() != self.position:
+            if self._job_started(match.groups()):
+                self.jobs += 1
+            self.position = match.groups()
+            self.last_change = time.time()
+
+    # A job starts with its scan, or when the encode progress goes back (the
+    # task numbers only count the passes of one job)
+    def _job_started(self, position):
+        if self.position is None:
+            return True
+        (kind, number, preview, percent) = position
+        (last_kind, last_number, last_preview, last_percent) = self.position
+        if kind != last_kind:
+            return kind == 'Scanning title'
+        if kind == 'Encoding: task':
+            return (int(number), float(percent)) < (int(last_number), float(last_percent))
+        return False
+
+    # Seconds since the progress last moved
+    def idle(self):
+        return time.time() - self.last_change
+
+
+class HandbrakeTimeout(Exception):
+    pass
+
+# Everything that went wrong during the run, as (source, title, reason)
+failures = []
+
+def record_failure(source, title, reason):
+    failures.append((source, title, reason))
+    logger.error("%s%s: %s" %(source, title and ' title %s' %title or '', reason))
+
+def report_failures():
+    if len(failures) > 0:
+        logger.error("\nThe following failed and were skipped:")
+        for (source, title, reason) in failures:
+            logger.error("%s%s: %s" %(source, title and ' title %s' %title or '', reason))
+
+# Where the time of a run went. Keeps the duration of every step of each phase
+# (e.g. every disc scan), the bytes read from the sources and written by the
+# encodes, and how much video was encoded.
+class RunStats():
+    def __init__(self):
+        # Scans can run in several threads at once
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.order = []
+        # What brakejob reads itself (fingerprints and staging copies)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # What HandBrake read of the encoded titles, as far as their size is
+        # known
+        self.source_bytes = 0
+        self.unsized_titles = 0
+        self.video_seconds = 0
+
+    def add(self, phase, seconds):
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = []
+                self.order.append(phase)
+            self.phases[phase].append(seconds)
+
+    def read(self, count):
+        with self.lock:
+            self.bytes_read += count
+
+    # A title 'duration' seconds and 'size' bytes (None when unknown) long was
+    # encoded to 'output'
+    def encoded(self, output, duration, size = None):
+        with self.lock:
+            if os.path.isfile(output):
+                self.bytes_written += os.path.getsize(output)
+            if size is None:
+                self.unsized_titles += 1
+            else:
+                self.source_bytes += size
+            self.video_seconds += duration
+
+    def summary(self):
+        with self.lock:
+            phases = {}
+            for (phase, times) in self.phases.items():
+                times = sorted(times)
+                # Nearest rank percentile
+                p95 = times[int(math.ceil(0.95 * len(times))) - 1]
+                phases[phase] = {'count': len(times), 'total': sum(times), 'mean': sum(times) / len(times), 'p95': p95}
+            encoding = sum(self.phases.get('encode', []) + self.phases.get('queue', []))
+            speed = None
+            if encoding > 0 and self.video_seconds > 0:
+                speed = self.video_seconds / encoding
+            return {'elapsed': time.time() - self.started, 'phases': phases, 'order': list(self.order), \
+                    'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written, \
+                    'source_bytes': self.source_bytes, 'unsized_titles': self.unsized_titles, \
+                    'video_seconds': self.video_seconds, 'encode_speed': speed}
+
+stats = RunStats()
+
+def report_stats(path = None):
+    summary = stats.summary()
+    logger.info("\nRun summary (%.1f sec):" %summary['elapsed'])
+    for phase in summary['order']:
+        timing = summary['phases'][phase]
+        logger.info("  %-12s %4d x  total %8.1f sec  mean %7.2f sec  p95 %7.2f sec" \
+            %(phase, timing['count'], timing['total'], timing['mean'], timing['p95']))
+    logger.info("  brakejob read %.1f MB (fingerprints and staging), encodes wrote %.1f MB" \
+        %(summary['bytes_read'] / 1048576.0, summary['bytes_written'] / 1048576.0))
+    if summary['source_bytes']:
+        unsized = ''
+        if summary['unsized_titles']:
+            unsized = ", not counting %d titles the scan didn't give the size of" %summary['unsized_titles']
+        logger.info("  HandBrake read about %.1f MB of titles%s" %(summary['source_bytes'] / 1048576.0, unsized))
+    if summary['encode_speed']:
+        logger.info("  encoded %d sec of video at %.2fx realtime" %(summary['video_seconds'], summary['encode_speed']))
+    if path:
+        del summary['order']
+        save_json(path, summary, indent = 2)
+
+# --profile support: cProfile stats of brakejob's own (Python) work in each
+# phase, kept apart from the time spent waiting on HandBrake. There's no
+# tracemalloc in Python 2, so memory is looked at through the growth in the
+# number of live objects of each type during the phase, and the peak memory
+# use of the whole process.
+class PhaseProfiler():
+    PHASES = ['discovery', 'parsing', 'planning']
+    HOTSPOTS = 15
+
+    def __init__(self, path):
+        self.path = path
+        # Only one profiler can be active per thread, and scans can parse in
+        # several threads, so profiled calls run one at a time
+        self.lock = threading.RLock()
+        self.profiles = {}
+        # Live objects by type when each phase started, and how many more
+        # there were when it ended. Counting them walks the whole heap, so
+        # only at the phase boundaries rather than around every call.
+        self.started = {}
+        self.growth = {}
+
+    def call(self, phase, function, *args, **kwargs):
+        with self.lock:
+            if phase not in self.profiles:
+                self.profiles[phase] = cProfile.Profile()
+                self.started[phase] = _object_counts()
+            return self.profiles[phase].runcall(function, *args, **kwargs)
+
+    # The phase is over. Phases that are never ended explicitly end with the run.
+    def end(self, phase):
+        with self.lock:
+            if phase not in self.started or phase in self.growth:
+                return
+            before = self.started[phase]
+            after = _object_counts()
+            self.growth[phase] = dict([(name, after.get(name, 0) - before.get(name, 0)) \
+                                       for name in set(before.keys() + after.keys())])
+
+    # Writes a <phase>.prof pstats file for each phase and logs the hotspots
+    def report(self):
+        for phase in self.PHASES:
+            if phase not in self.profiles:
+                continue
+            self.end(phase)
+            filename = os.path.join(self.path, phase + '.prof')
+            self.profiles[phase].dump_stats(filename)
+            out = StringIO()
+            profile_stats = pstats.Stats(self.profiles[phase], stream = out)
+            profile_stats.sort_stats('cumulative').print_stats(self.HOTSPOTS)
+            logger.info("\nProfile of %s (%s):" %(phase, filename))
+            logger.info(out.getvalue().strip())
+            growth = sorted([(count, name) for (name, count) in self.growth[phase].items() if count > 0], reverse = True)
+            if growth:
+                logger.info("Live objects added during the phase: %s" %', '.join(["%s +%d" %(name, count) for (count, name) in growth[:5]]))
+        if resource:
+            logger.info("\nPeak memory use: %s (kB on Linux, bytes on Mac OS X)" %resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+profiler = None
+
+# Calls function(*args, **kwargs), profiling it as part of 'phase' when --profile is on
+def profiled(phase, function, *args, **kwargs):
+    if profiler:
+        return profiler.call(phase, function, *args, **kwargs)
+    return function(*args, **kwargs)
+
+def end_phase(phase):
+    if profiler:
+        profiler.end(phase)
+
+def _object_counts():
+    counts = {}
+    for o in gc.get_objects():
+        name = type(o).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+# Like itertools.imap(), but with up to 'jobs' calls running at once in worker
+# threads. Yields each result as soon as it (and all of the ones before it) are
+# done. With 'group', at most 'group_jobs' of the items with the same
+# group(item) run at once (e.g. sources on the same disk drive).
+def parallel_imap(function, items, jobs, group = None, group_jobs = None):
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield function(item)
+        return
+    results = {}
+    errors = []
+    pending = [(i, item, group and group(item)) for (i, item) in enumerate(items)]
+    running = {}
+    condition = threading.Condition()
+    # The first pending item whose group has room for it, or None
+    def next_item():
+        for (n, (i, item, key)) in enumerate(pending):
+            if not group_jobs or running.get(key, 0) < group_jobs:
+                running[key] = running.get(key, 0) + 1
+                return pending.pop(n)
+        return None
+    def work():
+        while True:
+            with condition:
+                job = None
+                while pending and not errors:
+                    job = next_item()
+                    if job:
+                        break
+                    condition.wait(0.1)
+                if not job:
+                    return
+                (i, item, key) = job
+            try:
+                result = function(item)
+                with condition:
+                    results[i] = result
+                    running[key] -= 1
+                    condition.notify_all()
+            except Exception:
+                with condition:
+                    errors.append(sys.exc_info())
+                    condition.notify_all()
+    workers = [threading.Thread(target = work) for i in range(min(jobs, len(items)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for i in range(len(items)):
+        with condition:
+            while i not in results and not errors:
+                # Wait with a timeout so Ctrl-C still gets through
+                condition.wait(0.1)
+            if errors:
+                (error_type, error, tb) = errors[0]
+                raise error_type, error, tb
+            result = results.pop(i)
+        yield result
+
 
 # Just raw interaction with the HandBrake CLI goes here, no actual decisions
 # or 'smarts'
 class Handbrake():
     
     hb_path = None
+    cache_dir = None
+    _capabilities = None
     
-    def __init__(self, hb_path):
+    def __init__(self, hb_path, cache_dir = None):
         self.hb_path = hb_path
+        self.cache_dir = cache_dir
+
+    # What this HandBrake CLI can do: version, options and audio encoders. Only
+    # probed once per binary, the result is kept in the cache dir.
+    def capabilities(self):
+        if self._capabilities is None:
+            stat = os.stat(self.hb_path)
+            key = os.path.abspath(self.hb_path)
+            cache = {}
+            if self.cache_dir:
+                cache = load_json(os.path.join(self.cache_dir, HANDBRAKE_CACHE), {})
+            entry = cache.get('binaries', {}).get(key)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                self._capabilities = entry['capabilities']
+            else:
+                self._capabilities = self._probe()
+                # A probe that found nothing (e.g. the CLI failed to start) is
+                # tried again next time
+                found = self._capabilities['version'] or self._capabilities['options']
+                if self.cache_dir and found:
+                    cache.setdefault('binaries', {})[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, \
+                                                            'capabilities': self._capabilities}
+                    save_json(os.path.join(self.cache_dir, HANDBRAKE_CACHE), cache)
+        return self._capabilities
+
+    def _probe(self):
+        logger.debug("Probing %s" %self.hb_path)
+        help_text = self.call(raw_options = ['--help'], ignore_output = False) or ''
+        # Older versions don't have --version, but print it along with --help
+        version_text = self.call(raw_options = ['--version'], ignore_output = False) or ''
+        version = re.search(r"HandBrake(?:CLI)? (\d+\.\d+\.\d+)", version_text + help_text)
+        options = sorted(set(re.findall(r"--[a-z][a-z0-9-]*", help_text)))
+        encoders = [e for e in AUDIO_ENCODERS if re.search(r"(?<![\w:])" + re.escape(e) + r"(?![\w:])", help_text)]
+        return {'version': version and version.group(1), 'options': options, 'audio_encoders': encoders}
+
+    # Whether the HandBrake CLI lists the given option in its help
+    def supports(self, option):
+        return option in self.capabilities()['options']
+
+    def aac_encoder(self):
+        for encoder in AAC_ENCODERS:
+            if encoder in self.capabilities()['audio_encoders']:
+                return encoder
+        return DEFAULT_AUDIO_ENCODER
         
-    def call(self, dict_options = None, raw_options = None, ignore_output = True):
+    # 'watch' gets each line HandBrake logs while encoding
+    def call(self, dict_options = None, raw_options = None, ignore_output = True, watch = None, timeout = None):
+        return self.run(dict_options, raw_options, ignore_output, watch, timeout).output
+
+    # Same as call(), but returns the whole ProcessResult. See
+    # ProcessSupervisor.run() for 'progress' and 'stall_timeout'.
+    def run(self, dict_options = None, raw_options = None, ignore_output = True, watch = None, timeout = None, \
+            progress = None, stall_timeout = None):
         args = []
         if (raw_options):
             args += raw_options
         if (dict_options):
-            args += self._convert_dict_to_args(dict_options)
+            args += self.convert_dict_to_args(dict_options)
         call = [self.hb_path] + args
         if ignore_output:
             # Output will just goto console, nice during rendering so user sees the progress
             logger.debug("ENCODING: " + str(call))
-            p = subprocess.Popen(call)
+            result = supervisor.run(call, watch = watch, timeout = timeout, progress = progress, stall_timeout = stall_timeout)
         else:
             # Capture the output so we can parse it
             logger.debug("CALLING: " + str(call))
-            p = subprocess.Popen(call, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        output = p.communicate()[0]
-        return output
+            result = supervisor.run(call, capture = True, watch = watch, timeout = timeout)
+        return result
     
-    def _convert_dict_to_args(self, options):
+    def convert_dict_to_args(self, options):
         args = []
         for option in options.keys():
             args.append("--"+str(option))
@@ -112,51 +652,141 @@ class Handbrake():
         if (raw_options):
             args += raw_options
         if (dict_options):
-            args += self._convert_dict_to_args(dict_options)
+            args += self.convert_dict_to_args(dict_options)
         call = [self.hb_path] + args
         logger.info(' '.join(call))
         
     # Returns duration and subtitle info about each title on the DVD
-    def get_disc_info(self, input_file):
+    # scan_options are passed along to cut down the scan work, e.g. min-duration
+    # use_json: ask for HandBrake's JSON title set instead of the log text
+    def get_disc_info(self, input_file, scan_options = None, timeout = None, use_json = False):
         title_options = {'title':0, 'input':input_file}
-        output = self.call(dict_options = title_options, ignore_output = False)
+        if scan_options:
+            title_options.update(scan_options)
+        raw_options = None
+        if use_json:
+            raw_options = ['--json', '--scan']
+        result = self.run(dict_options = title_options, raw_options = raw_options, ignore_output = False, timeout = timeout)
+        if result.timed_out:
+            raise HandbrakeTimeout("Scanning %s timed out after %s sec" %(input_file, timeout))
+        titles = None
+        if use_json:
+            titles = profiled('parsing', self.parse_scan_json, result.output)
+        if titles is None:
+            titles = profiled('parsing', self.parse_scan_text, result.output)
+        disc = None
+        if len(titles) > 0:
+            disc = DiscInfo(path = input_file, titles = titles)
+        return disc
+
+    # Titles from the 'JSON Title Set: {...}' part of the output, or None when
+    # there is no such thing. The object is decoded right where it is in the
+    # output, the surrounding log lines are never split or copied.
+    def parse_scan_json(self, output):
+        marker = output.find(JSON_TITLE_SET)
+        if marker < 0:
+            return None
+        start = output.find('{', marker)
+        try:
+            (title_set, end) = json.JSONDecoder().raw_decode(output, start)
+        except ValueError, err:
+            logger.debug("Couldn't decode the JSON title set: %s" %err)
+            return None
+        titles = []
+        for json_title in title_set.get('TitleList', []):
+            subtitles = []
+            for (i, track) in enumerate(json_title.get('SubtitleList', [])):
+                subtitles.append((i + 1, str(track.get('LanguageCode', 'und'))))
+            audio = []
+            for (i, track) in enumerate(json_title.get('AudioList', [])):
+                channels = track.get('ChannelLayoutName')
+                audio.append((i + 1, str(track.get('LanguageCode', 'und')), str((track.get('CodecName') or '').upper()) or None, \
+                              JSON_CHANNEL_LAYOUTS.get(channels, channels)))
+            chapters = [self._convert_json_duration_to_seconds(c.get('Duration', {})) for c in json_title.get('ChapterList', [])]
+            titles.append(Title(json_title['Index'], self._convert_json_duration_to_seconds(json_title.get('Duration', {})), \
+                                chapters, subtitles, audio))
+        return titles
+
+    def _convert_json_duration_to_seconds(self, duration):
+        return duration.get('Hours', 0) * 3600 + duration.get('Minutes', 0) * 60 + duration.get('Seconds', 0)
+
+    # Titles from the '+ title' listing HandBrake logs after scanning
+    def parse_scan_text(self, output):
         tokens = self._get_handbrake_title_pattern().scanString(output)
         titles = []
         for (token,start,end) in tokens:
             seconds = self._convert_duration_to_seconds(token.duration)
-            subtitles = {}
+            subtitles = []
             # Subtitle data is an array of (#,lang) array pairs. Not ideal but it's
             # the best I can figure out how to get out of pyparsing
             for subdata in token.subtitles:
-                subtitles[subdata[0]] = subdata[1]
-            title = {'title':token.title, 'duration':seconds, 'subtitles':subtitles}
-            titles.append(title)
-        disc = None
-        if len(titles) > 0:
-            disc = DiscInfo(path = input_file, titles = titles)
-        return disc
+                subtitles.append((int(subdata[0]), subdata[1]))
+            # Audio tracks are (#, lang, codec, channels)
+            audio = []
+            for audiodata in token.audio:
+                (codec, channels) = self._parse_audio_description(audiodata[1])
+                audio.append((int(audiodata[0]), audiodata[2], codec, channels))
+            chapters = [self._convert_duration_to_seconds(c) for c in token.chapters]
+            vts = None
+            blocks = None
+            if token.vts:
+                vts = int(token.vts)
+                blocks = int(token.blocks)
+            titles.append(Title(token.title, seconds, chapters, subtitles, audio, vts, blocks))
+        return titles
 
     # Always returns constant pattern
     def _get_handbrake_title_pattern(self):
         title = Literal("+ title").suppress()
         integer = Word("0123456789")
         time = Combine(integer + ":" + integer + ":" + integer)
+        vts = Literal("+ vts").suppress()
         duration = Literal("+ duration:").suppress()
+        chapter = Literal("+ chapters:")
+        chapter_entry = Literal("+").suppress() + integer.suppress() + Literal(":").suppress() + \
+            SkipTo(Literal("duration")).suppress() + Literal("duration").suppress() + time
+        audio = Literal("+ audio tracks:")
         subtitle = Literal("+ subtitle tracks:")
         iso = Literal('(iso639-2:').suppress() + Word(alphas)
-        subtitle_track = Literal("+").suppress() + Group(integer + SkipTo(iso).suppress() + iso) + restOfLine.suppress()
+        # Audio and subtitle tracks are both listed as '+ #, description (iso639-2: lang)...'
+        track = Literal("+").suppress() + Group(integer + SkipTo(iso).suppress() + iso) + restOfLine.suppress()
+        # ...but the audio description has the codec and channels, e.g. 'English (AC3) (5.1 ch)'
+        audio_track = Literal("+").suppress() + Group(integer + Literal(",").suppress() + SkipTo(iso) + iso) + restOfLine.suppress()
 
         title_num = integer.setResultsName("title")
+        vts_num = integer.setResultsName("vts")
+        blocks_num = integer.setResultsName("blocks")
         duration_num = time.setResultsName("duration")
-        subtitles = Group(ZeroOrMore(subtitle_track)).setResultsName("subtitles")
+        chapters = Group(ZeroOrMore(chapter_entry)).setResultsName("chapters")
+        audios = Group(ZeroOrMore(audio_track)).setResultsName("audio")
+        subtitles = Group(ZeroOrMore(track)).setResultsName("subtitles")
 
-        pattern = title + title_num + \
+        # e.g. '+ vts 1, ttn 1, cells 0->7 (1466924 blocks)', not every source has one
+        vts_info = Optional(SkipTo(vts, failOn=duration).suppress() + vts + vts_num + \
+            SkipTo(Literal("(")).suppress() + Literal("(").suppress() + blocks_num)
+
+        pattern = title + title_num + vts_info + \
             SkipTo(duration).suppress() + \
             duration + duration_num + \
+            SkipTo(chapter).suppress() + chapter.suppress() + chapters + \
+            Optional(SkipTo(audio, failOn=subtitle).suppress() + audio.suppress() + audios) + \
             SkipTo(subtitle).suppress() + subtitle.suppress() + subtitles
             
         return pattern
         
+    # 'English (AC3) (5.1 ch)' -> ('AC3', '5.1')
+    def _parse_audio_description(self, description):
+        codec = None
+        channels = None
+        for detail in re.findall(r"\(([^()]*)\)", description):
+            if detail.endswith(' ch'):
+                channels = detail[:-3]
+            elif detail == 'Dolby Surround':
+                channels = '2.0'
+            elif codec is None:
+                codec = detail.upper()
+        return (codec, channels)
+
     def _convert_duration_to_seconds(self, duration):
         (hours,minutes,seconds) = duration.split(':')
         seconds = (int(hours) * 3600) + (int(minutes) * 60) + int(seconds)
@@ -165,12 +795,203 @@ class Handbrake():
     def encode_disc(self, settings):
         self.call(dict_options = settings)
 
+    # Encodes several titles of one disc with a single HandBrake CLI process, so
+    # the disc is only scanned once. HandBrake ignores command line encoding
+    # options when importing a queue, so the encoding settings come from a queue
+    # job exported from HandBrake ('template') and each job only fills in the
+    # title specific options. Returns the ProcessResult.
+    def encode_queue(self, template, jobs, stall_timeout = None):
+        queue = []
+        for (sequence_id, options) in enumerate(jobs):
+            queue.append({'Job': self._convert_dict_to_job(template, options, sequence_id + 1)})
+        (fd, queue_file) = tempfile.mkstemp(prefix = 'brakejob', suffix = '.json')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(queue, f, indent = 2)
+            finally:
+                f.close()
+            progress = ProgressMonitor()
+            result = self.run(raw_options = ['--queue-import-file', queue_file], \
+                progress = progress, stall_timeout = stall_timeout)
+            # How many of the jobs HandBrake got to, the last one was running
+            result.jobs_started = progress.jobs
+            if result.stalled:
+                logger.error("Stopped the queue because it stalled for %s sec" %stall_timeout)
+            return result
+        finally:
+            os.remove(queue_file)
+
+    def sim_queue(self, template, jobs):
+        logger.info(' '.join([self.hb_path, '--queue-import-file', '<queue>']) + \
+            ' (titles %s)' %', '.join([str(options['title']) for options in jobs]))
+
+    def _convert_dict_to_job(self, template, options, sequence_id):
+        job = copy.deepcopy(template)
+        job['SequenceID'] = sequence_id
+        source = job.setdefault('Source', {})
+        source['Path'] = options['input']
+        source['Title'] = int(options['title'])
+        chapters = options.get('chapters')
+        if chapters:
+            source['Range'] = {'Type': 'chapter', 'Start': 1, 'End': chapters}
+        else:
+            source.pop('Range', None)
+        destination = job.setdefault('Destination', {})
+        destination['File'] = options['output']
+        # Chapter names belong to the template's title
+        destination.pop('ChapterList', None)
+
+        tracks = []
+        if options.get('subtitle'):
+            tracks = options['subtitle'].split(',')
+        # subtitle-burn/forced are either 'scan' or a (1 based) position in the
+        # subtitle list
+        burn = options.get('subtitle-burn')
+        forced = options.get('subtitle-forced')
+        search = {'Enable': 'scan' in tracks, 'Burn': burn == 'scan', 'Forced': forced == 'scan', 'Default': False}
+        subtitle_list = []
+        for (position, track) in enumerate(tracks):
+            if track != 'scan':
+                position = str(position + 1)
+                subtitle_list.append({'Track': int(track) - 1, 'Burn': burn == position, \
+                                      'Forced': forced == position, 'Default': False})
+        job['Subtitle'] = {'Search': search, 'SubtitleList': subtitle_list}
+
+        if options.get('audio'):
+            audio_list = []
+            for (track, encoder) in zip(options['audio'].split(','), options['aencoder'].split(',')):
+                audio_list.append({'Track': int(track) - 1, 'Encoder': encoder})
+            job.setdefault('Audio', {})['AudioList'] = audio_list
+        return job
+
+
+# Watches the log of an encode using HandBrake's foreign audio search ('scan'
+# subtitle) to find out which subtitle track it picked
+class SubtitleSearch():
+
+    # e.g. "Subtitle stream 0x20bd 'English': 1000 hits (0 forced)"
+    pattern = re.compile(r"Subtitle (?:stream|track \d+ \(id) 0x([0-9a-f]+)\)? '[^']*': (\d+) hits \((\d+) forced\)")
+
+    def __init__(self):
+        self.hits = []
+
+    def watch(self, line):
+        match = self.pattern.search(line)
+        if match:
+            (stream_id, hits, forced) = match.groups()
+            # DVD subtitle streams are 0x20bd, 0x21bd, ... for tracks 1, 2, ...
+            track = str(((int(stream_id, 16) >> 8) & 0x1f) + 1)
+            self.hits.append((track, int(hits), int(forced)))
+
+    # Same decision as HandBrake: a track with forced subtitles, or else one
+    # that is only shown for a small part of the title
+    def forced_track(self):
+        forced = [h for h in self.hits if h[2] > 0]
+        if len(forced) > 0:
+            forced.sort(key=lambda h: -h[2])
+            return forced[0][0]
+        if len(self.hits) > 1:
+            most = max([h[1] for h in self.hits])
+            rare = [h for h in self.hits if 0 < h[1] < most * 0.1]
+            if len(rare) > 0:
+                return rare[0][0]
+        return None
+
+
+# Language -> subtitle track numbers (lowest first), for every subtitle layout
+# seen so far. Titles with the same layout (usually all of the episodes of a TV
+# disc) share one index.
+_subtitle_indexes = {}
+
+def _subtitle_index(tracks):
+    index = _subtitle_indexes.get(tracks)
+    if index is None:
+        langs = {}
+        for (track, lang) in sorted(tracks):
+            langs.setdefault(lang, []).append(track)
+        index = _subtitle_indexes.setdefault(tracks, dict([(lang, tuple(numbers)) for (lang, numbers) in langs.items()]))
+    return index
+
+# One scanned title. A library can have a lot of these, so they're kept small:
+# slots instead of a dict, the title number as an integer and the subtitle and
+# audio tracks as tuples of (track, lang) and (track, lang, codec, channels) in
+# track order. Dict style access (title['duration'], title.get('vts')) still
+# works, with 'subtitles' and 'audio' as the track number keyed dicts they
+# always were.
+class Title(object):
+
+    __slots__ = ('title', 'duration', 'chapters', 'subtitle_tracks', 'subtitle_langs', 'audio_tracks', 'vts', 'blocks', \
+                 'signature', 'args_hash')
+
+    def __init__(self, title, duration, chapters = (), subtitle_tracks = (), audio_tracks = (), vts = None, blocks = None):
+        self.title = int(title)
+        self.duration = duration
+        self.chapters = tuple(chapters)
+        self.subtitle_tracks = tuple(sorted(subtitle_tracks))
+        self.subtitle_langs = _subtitle_index(self.subtitle_tracks)
+        self.audio_tracks = tuple(audio_tracks)
+        self.vts = vts
+        self.blocks = blocks
+        # Set by TitleIndex
+        self.signature = None
+        # Set when the title is picked for encoding
+        self.args_hash = None
+
+    # Bytes HandBrake reads to encode the title, or None when the scan didn't say
+    def size(self):
+        if self.blocks is None:
+            return None
+        return self.blocks * ISO_SECTOR
+
+    def __getitem__(self, key):
+        if key == 'subtitles':
+            return dict([(str(track), lang) for (track, lang) in self.subtitle_tracks])
+        if key == 'audio':
+            return dict([(str(track[0]), track[1:]) for track in self.audio_tracks])
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ or key in ('subtitles', 'audio')
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    # The lowest numbered subtitle track of the language, or None. There might be
+    # several (e.g. director's commentary), usually the first is the regular one.
+    def subtitle_track(self, lang):
+        tracks = self.subtitle_langs.get(lang)
+        if tracks:
+            return tracks[0]
+        return None
+
+    def __repr__(self):
+        return "Title(%s, %s sec, %d chapters, audio %s, subtitles %s)" \
+            %(self.title, self.duration, len(self.chapters), self.audio_tracks, self.subtitle_tracks)
+
 
 class DiscInfo():
 
     path = None
     titles = None
     name = None
+    fingerprint = None
+    # All scanned titles, and the reason for each one that was filtered out
+    scanned_titles = None
+    skipped = None
+    # Found by the foreign audio search of an encode, by the subtitle tracks of
+    # the title it was found on
+    forced_subtitles = None
 
     def __init__(self, path, titles):
         if not path:
@@ -178,23 +999,72 @@ class DiscInfo():
         if len(titles) is 0:
             raise Exception('Trying to create disc with 0 titles')
         self.path = path
+        # The same list until titles are filtered out, filtering never changes
+        # it in place
         self.titles = titles
+        self.scanned_titles = titles
+        self.skipped = {}
+        self.forced_subtitles = {}
         (root, ext) = os.path.splitext(path)
         self.name = os.path.basename(root)
     
-    def is_tv_show(self):
-        # TODO Analyze show and make guess
+    def is_tv_show(self, threshold = DEFAULT_THRESHOLD):
+        # TV show discs have several titles of about the same (episode) length,
+        # movie discs have one long main feature (possibly hidden between a pile
+        # of near-identical decoys) and short extras.
+        #
+        # Like TvFilter, use the 2nd longest title as the baseline so a 'combined'
+        # title of all episodes doesn't throw the guess off. Duplicate durations
+        # only count once so decoys/duplicates don't look like a set of episodes.
+        durations = sorted(set([t['duration'] for t in self.titles if t['duration'] >= MIN_EPISODE_LENGTH]))
+        if len(durations) < 2:
+            return False
+        base_length = durations[-2]
+        if base_length > MAX_EPISODE_LENGTH:
+            return False
+        margin = threshold * base_length
+        episodes = [d for d in durations if abs(d - base_length) <= margin]
+        if len(episodes) < 2:
+            return False
+        # A long title that isn't just all of the episodes combined is a movie
+        # with a few similar length extras
+        longest = durations[-1]
+        combined = sum([t['duration'] for t in self.titles if abs(t['duration'] - base_length) <= margin])
+        if longest > MAX_EPISODE_LENGTH and longest > combined * (1 + threshold):
+            return False
         return True
         
     def __repr__(self):
         return self.path + '\n' + pformat(self.titles)
         
-    def filter(self, filter):
-        self.titles = filter.filter(self.titles)
+    # The forced subtitle track of 'title' when an earlier encode found it, or
+    # None. Track numbers only mean the same thing for titles with the same
+    # subtitle tracks. For other titles, it's their track of the same language,
+    # unless they have several of them and it can't be told which one.
+    def forced_subtitle(self, title):
+        track = self.forced_subtitles.get(title.subtitle_tracks)
+        if track:
+            return track
+        for (tracks, found) in self.forced_subtitles.items():
+            langs = [lang for (number, lang) in tracks if str(number) == found]
+            if len(langs) > 0 and len(title.subtitle_langs.get(langs[0], ())) == 1:
+                return str(title.subtitle_track(langs[0]))
+        return None
+
+    def filter(self, filter, reason = None):
+        before = self.titles
+        self.titles = filter.filter(list(self.titles))
+        kept = set([t.title for t in self.titles])
+        for title in before:
+            if title.title not in kept:
+                self.skipped[title.title] = reason
         
-    def remove_titles(self, titles):
-        # Remove the passed-in titles from the DiscInfo titles.
-        self.titles[:] = [t for t in self.titles if t.get('title') not in titles]
+    def remove_titles(self, titles, reason = None):
+        # Remove the passed-in titles (by number) from the DiscInfo titles.
+        titles = set([int(t) for t in titles])
+        self.titles = [t for t in self.titles if t.title not in titles]
+        for title in titles:
+            self.skipped[title] = reason
 
 
 class TvFilter():
@@ -223,7 +1093,7 @@ class TvFilter():
         # This currently does NOT take into account the occasional double-length
         # episode.
         
-        titles.sort(key=operator.itemgetter('duration'))
+        titles.sort(key=operator.attrgetter('duration'))
         base_length = int(titles[-2]['duration']) # Length of 2nd longest title
         threshold = int(self.threshold * int(base_length))
         min_length = base_length - threshold
@@ -241,59 +1111,1202 @@ class TvFilter():
                 
 
         # Put back in title order because that seems more natural
-        filtered.sort(key=operator.itemgetter('title'))
+        filtered.sort(key=operator.attrgetter('title'))
         return filtered
  
 class MovieFilter():
 
-    #TODO
+    threshold = None
+
+    def __init__(self, threshold = 0.10):
+        self.threshold = threshold
+
+    # Only encode the title we think is the main feature
     def filter(self, titles):
-        return titles
+        if len(titles) < 1:
+            raise Exception("This doesn't look like a movie disc")
+
+        # The main feature is normally just the longest title. Discs using playlist
+        # obfuscation add dozens of decoy titles that are all about as long as the
+        # movie though. The decoys are generated from the same template, so they
+        # share their structure (length and chapter layout) with each other, while
+        # the real feature is the odd one out.
+        longest = max([t['duration'] for t in titles])
+        min_length = longest - int(self.threshold * longest)
+        candidates = [t for t in titles if t['duration'] >= min_length]
+
+        structures = {}
+        for title in candidates:
+            structure = _title_structure(title)
+            structures[structure] = structures.get(structure, 0) + 1
+        unique = [t for t in candidates if structures[_title_structure(t)] == 1]
+        if len(unique) > 0:
+            candidates = unique
+        elif len(candidates) > 1:
+            logger.warning("Couldn't tell the main feature apart from its decoys, using the longest title. Please manually verify!")
+
+        # Longest wins, lowest title number breaks ties
+        candidates.sort(key=lambda t: (-t['duration'], t['title']))
+        feature = candidates[0]
+        for title in titles:
+            if title is not feature:
+                logger.debug("Skipping title %s because it doesn't appear to be the main feature: %s sec" %(title['title'], title['duration']))
+        return [feature]
+
+# Titles with the same length and chapter layout were most likely made from
+# the same playlist
+def _title_structure(title):
+    return (title['duration'], len(title.get('chapters', [])))
 
 
 def duplicate_filter(disc):
     titles = disc.titles
 
     filtered = []
-    added_list = []
+    added = set()
     for title in titles:
-        if title['duration'] not in added_list:
+        if title['duration'] not in added:
             #filtered.append(title)
-            added_list.append(title['duration'])
+            added.add(title['duration'])
         else:
             filtered.append(title['title'])
             #logger.debug("Skipping title %s because it looks like a duplicate. Please manually verify!" %title['title'])
     return filtered
 
-def encode_disc_with_settings(disc, handbrake, encode_settings):
+class TitleIndex():
+
+    kept = None
+    content_hash = None
 
-    if encode_settings['tv_detection']:
-        disc.filter(TvFilter(threshold = encode_settings['threshold']))
+    # Library-wide index of title signatures, used to find the same episode on
+    # several discs (box sets, re-releases, etc). Only the disc name and title
+    # number of the first copy of each title are kept, not the discs themselves.
+    def __init__(self, content_hash = False):
+        self.kept = {}
+        self.content_hash = content_hash
+        self._vob_hashes = {}
+
+    # Called for each disc as it's scanned, before any filtering
+    def add_disc(self, disc):
+        for title in disc.titles:
+            title['signature'] = self._signature(disc, title)
+
+    # Same length, chapter layout and audio/subtitle layout (and optionally the
+    # same sampled VOB content) means the same episode as far as we're concerned
+    def _signature(self, disc, title):
+        signature = (title.duration, title.chapters, \
+                     _track_layout(title.audio_tracks), _track_layout(title.subtitle_tracks))
+        if self.content_hash and title.get('vts'):
+            signature += (self._vob_hash(disc.path, title['vts']),)
+        return signature
+
+    def _vob_hash(self, path, vts):
+        key = (path, vts)
+        if key not in self._vob_hashes:
+            files = _vts_vob_files(path, vts)
+            if files:
+                self._vob_hashes[key] = _sample_hash([(f, 0, os.path.getsize(f)) for f in files])
+            else:
+                # Probably an iso, nothing we can cheaply look at
+                self._vob_hashes[key] = None
+        return self._vob_hashes[key]
+
+    # Removes every selected title of the (filtered) disc that was already
+    # selected on an earlier disc. Discs must be passed in the order they should
+    # be kept in. Returns a list of (title, kept disc name, kept title number)
+    # for the skipped copies.
+    def remove_duplicates(self, disc):
+        skipped = []
+        for title in disc.titles:
+            signature = title.get('signature')
+            if signature is None:
+                continue
+            if signature in self.kept:
+                (kept_disc, kept_title) = self.kept[signature]
+                if kept_disc != disc.path:
+                    skipped.append((title, os.path.basename(os.path.splitext(kept_disc)[0]), kept_title))
+            else:
+                self.kept[signature] = (disc.path, title['title'])
+        for (title, kept_name, kept_title) in skipped:
+            disc.remove_titles([title['title']], "same as %s title %s" %(kept_name, kept_title))
+        return skipped
+
+# Track details in track order, e.g. ('eng', 'fra')
+def _track_layout(tracks):
+    return tuple([track[1:] for track in tracks])
+
+# The VIDEO_TS folder of a disc folder (or the folder itself)
+def _video_ts_dir(path):
+    for filename in os.listdir(path):
+        if filename.lower() == 'video_ts' and os.path.isdir(os.path.join(path, filename)):
+            return os.path.join(path, filename)
+    return path
+
+# The VTS_##_#.VOB files holding the given title set of a VIDEO_TS folder
+def _vts_vob_files(path, vts):
+    if not os.path.isdir(path):
+        return []
+    path = _video_ts_dir(path)
+    prefix = 'vts_%02d_' %int(vts)
+    files = []
+    for filename in os.listdir(path):
+        (root, ext) = os.path.splitext(filename.lower())
+        # VTS_##_0.VOB is the menu, not part of the titles
+        if root.startswith(prefix) and ext == '.vob' and root != prefix + '0':
+            files.append(os.path.join(path, filename))
+    files.sort(key=lambda f: f.lower())
+    return files
+
+# Identifies the video content of an iso or VIDEO_TS folder, so the same disc
+# is recognized no matter where (or in which form) it was copied to.
+def source_fingerprint(path):
+    try:
+        extents = _source_vob_extents(path)
+        if not extents and os.path.isfile(path):
+            # Not a DVD layout we understand, just sample the whole file
+            extents = [(path, 0, os.path.getsize(path))]
+        if not extents:
+            return None
+        return _sample_hash(extents)
+    except (IOError, OSError), err:
+        logger.debug("Couldn't fingerprint %s: %s" %(path, err))
+        return None
+
+# All of the VOB files of a disc as (path, offset, length) extents, sorted by name
+def _source_vob_extents(path):
+    if os.path.isfile(path):
+        return _iso_vob_extents(path)
+    video_ts = _video_ts_dir(path)
+    extents = []
+    for filename in sorted(os.listdir(video_ts), key=lambda f: f.lower()):
+        if filename.lower().endswith('.vob'):
+            filename = os.path.join(video_ts, filename)
+            extents.append((filename, 0, os.path.getsize(filename)))
+    return extents
+
+# DVD isos carry an ISO9660 file system next to the UDF one, which is simple
+# enough to find the VIDEO_TS/*.VOB files without any extra libraries.
+def _iso_vob_extents(path):
+    f = open(path, 'rb')
+    try:
+        f.seek(16 * ISO_SECTOR)
+        descriptor = f.read(ISO_SECTOR)
+        if len(descriptor) < 190 or descriptor[0:6] != '\x01CD001':
+            return []
+        root = _iso_dir_records(f, descriptor[156:190])
+        if 'VIDEO_TS' not in root:
+            return []
+        extents = []
+        files = _iso_dir_records(f, root['VIDEO_TS'])
+        for name in sorted(files.keys(), key=lambda f: f.lower()):
+            if name.lower().endswith('.vob'):
+                (lba, length) = struct.unpack('<I4xI', files[name][2:14])
+                extents.append((path, lba * ISO_SECTOR, length))
+        return extents
+    finally:
+        f.close()
+
+# Returns the records of the directory described by 'record', keyed by name
+def _iso_dir_records(f, record):
+    (lba, length) = struct.unpack('<I4xI', record[2:14])
+    f.seek(lba * ISO_SECTOR)
+    data = f.read(length)
+    records = {}
+    pos = 0
+    while pos < len(data):
+        size = ord(data[pos])
+        if size == 0:
+            # Records don't cross sector boundaries, skip the padding
+            pos = (pos // ISO_SECTOR + 1) * ISO_SECTOR
+            continue
+        entry = data[pos:pos + size]
+        name = entry[33:33 + ord(entry[32])].split(';')[0]
+        records[name] = entry
+        pos += size
+    return records
+
+# Keeps the first source of every group of identical sources
+def unique_sources(sources, fingerprints):
+    unique = []
+    seen = {}
+    for source in sources:
+        fingerprint = fingerprints.get(source)
+        if fingerprint is None:
+            unique.append(source)
+        elif fingerprint in seen:
+            logger.info("Skipping %s because it looks like a copy of %s" %(source, seen[fingerprint]))
+        else:
+            seen[fingerprint] = source
+            unique.append(source)
+    return unique
+
+# Cheap fingerprint of a (possibly huge) set of extents given as (path, offset,
+# length): hashes the total size and a few evenly spaced blocks, as if all of
+# the extents were one file, instead of reading everything.
+def _sample_hash(extents):
+    total = sum([length for (path, offset, length) in extents])
+    md5 = hashlib.md5(str(total))
+    if total > 0:
+        last = max(total - SAMPLE_SIZE, 0)
+        for i in range(SAMPLE_COUNT):
+            md5.update(_read_extents(extents, last * i // (SAMPLE_COUNT - 1), SAMPLE_SIZE))
+    return md5.hexdigest()
+
+def _read_extents(extents, pos, size):
+    data = []
+    for (path, offset, length) in extents:
+        if size <= 0:
+            break
+        if pos >= length:
+            pos -= length
+            continue
+        count = min(size, length - pos)
+        f = open(path, 'rb')
+        try:
+            f.seek(offset + pos)
+            data.append(f.read(count))
+            stats.read(count)
+        finally:
+            f.close()
+        size -= count
+        pos = 0
+    return ''.join(data)
+
+def filter_disc(disc, encode_settings):
+
+    threshold = encode_settings['threshold']
+    if encode_settings['auto_detection']:
+        if disc.is_tv_show(threshold):
+            logger.debug("%s looks like a TV show disc" %disc.name)
+            disc.filter(TvFilter(threshold = threshold), "not an episode")
+        else:
+            logger.debug("%s looks like a movie disc" %disc.name)
+            disc.filter(MovieFilter(threshold = threshold), "not the main feature")
+    elif encode_settings['tv_detection']:
+        disc.filter(TvFilter(threshold = threshold), "not an episode")
+    elif encode_settings['movie_detection']:
+        disc.filter(MovieFilter(threshold = threshold), "not the main feature")
 
     filtered_titles = duplicate_filter(disc)
     if len(filtered_titles) > 0:
         if encode_settings['duplicate_detection']:
-            disc.remove_titles(filtered_titles)
+            disc.remove_titles(filtered_titles, "duplicate title")
             logger.info("Skipping the following titles because they look like duplicates. Please manually verify!")
         else:
             logger.info("Potential duplicate titles found. Add --duplicate_detection to filter the following out:")
         for title in filtered_titles:
-            logger.info("Title "+title)
+            logger.info("Title %s" %title)
+        logger.info("")
+
+def report_library_duplicates(disc, skipped):
+    if len(skipped) > 0:
+        logger.info("Skipping the following titles because they were already found on another disc. Please manually verify!")
+        for (title, kept_name, kept_title) in skipped:
+            logger.info("%s title %s (same as %s title %s)" %(disc.name, title['title'], kept_name, kept_title))
         logger.info("")
 
+# One JSON record for the disc and one for each of its scanned titles, written
+# as soon as the disc is done so consumers can start on it right away
+def write_inventory(disc, settings, out):
+    records = [{'type': 'disc', 'path': disc.path, 'name': disc.name, 'fingerprint': disc.fingerprint, \
+                'titles': len(disc.scanned_titles)}]
+    for title in sorted(disc.scanned_titles, key=operator.attrgetter('title')):
+        audio = [{'track': n, 'lang': lang, 'codec': codec, 'channels': channels} \
+                 for (n, lang, codec, channels) in title.audio_tracks]
+        subtitles = [{'track': n, 'lang': lang} for (n, lang) in title.subtitle_tracks]
+        selected = title['title'] not in disc.skipped
+        output = None
+        if selected:
+            output = calc_handbrake_args(disc, title, settings)['output']
+        records.append({'type': 'title', 'disc': disc.path, 'title': title['title'], 'duration': title['duration'], \
+                        'chapters': title['chapters'], 'audio': audio, 'subtitles': subtitles, \
+                        'selected': selected, 'skipped': disc.skipped.get(title['title']), 'output': output})
+    for record in records:
+        out.write(json.dumps(record) + '\n')
+    out.flush()
+
+# Every disc scanned so far (the latest scan of each), kept between runs in the
+# cache directory so questions about the whole library can be answered without
+# scanning. The titles are kept column by column in arrays, with the titles of
+# a disc next to each other, and the titles having each subtitle and audio
+# language are indexed by row.
+class Catalog():
+
+    # Name and item size in bytes
+    COLUMNS = [('disc', 4), ('title', 2), ('duration', 4), ('selected', 1)]
+    # Size of row numbers
+    ROW_SIZE = 4
+
+    def __init__(self, path):
+        self.path = path
+        # By disc id
+        self.discs = []
+        self.fingerprints = []
+        # Rows of disc n are starts[n] up to starts[n + 1]
+        self.starts = _sized_array(self.ROW_SIZE, [0])
+        # By row, '' when the title isn't selected
+        self.outputs = []
+        self.columns = dict([(name, _sized_array(size)) for (name, size) in self.COLUMNS])
+        # Language -> rows
+        self.subtitles = {}
+        self.audio = {}
+        # Discs scanned during this run, written out by save()
+        self.updated = {}
+        self.updated_order = []
+
+    def load(self):
+        data = load_json(self.path, None)
+        if not data or data.get('version') != CATALOG_VERSION:
+            return self
+        self.discs = data['discs']
+        self.fingerprints = data['fingerprints']
+        self.outputs = data['outputs']
+        self.starts = _decode_array(self.ROW_SIZE, data['starts'])
+        for (name, size) in self.COLUMNS:
+            self.columns[name] = _decode_array(size, data['columns'][name])
+        self.subtitles = dict([(lang, _decode_array(self.ROW_SIZE, rows)) for (lang, rows) in data['subtitles'].items()])
+        self.audio = dict([(lang, _decode_array(self.ROW_SIZE, rows)) for (lang, rows) in data['audio'].items()])
+        return self
+
+    # Replaces whatever the catalog knew about the (filtered) disc. 'outputs' are
+    # the output paths of the selected titles, by title number (none for a title
+    # whose output is another title's).
+    def add_disc(self, disc, outputs):
+        rows = []
+        for title in sorted(disc.scanned_titles, key=operator.attrgetter('title')):
+            rows.append((title.title, title.duration, title.title not in disc.skipped, outputs.get(title.title, ''), \
+                         [lang for (track, lang) in title.subtitle_tracks], [track[1] for track in title.audio_tracks]))
+        if disc.path not in self.updated:
+            self.updated_order.append(disc.path)
+        self.updated[disc.path] = (disc.fingerprint, rows)
+
+    def save(self):
+        if not self.updated:
+            return
+        subtitles = _rows_by_index(self.subtitles, len(self.outputs))
+        audio = _rows_by_index(self.audio, len(self.outputs))
+        discs = []
+        for (i, path) in enumerate(self.discs):
+            if path in self.updated:
+                discs.append((path,) + self.updated.pop(path))
+                continue
+            rows = []
+            for row in range(self.starts[i], self.starts[i + 1]):
+                rows.append((self.columns['title'][row], self.columns['duration'][row], self.columns['selected'][row], \
+                             self.outputs[row], subtitles[row], audio[row]))
+            discs.append((path, self.fingerprints[i], rows))
+        for path in self.updated_order:
+            if path in self.updated:
+                discs.append((path,) + self.updated[path])
+        self._build(discs)
+        self.updated = {}
+        self.updated_order = []
+        save_json(self.path, {'version': CATALOG_VERSION, 'discs': self.discs, 'fingerprints': self.fingerprints, \
+            'outputs': self.outputs, 'starts': _encode_array(self.starts), \
+            'columns': dict([(name, _encode_array(column)) for (name, column) in self.columns.items()]), \
+            'subtitles': dict([(lang, _encode_array(rows)) for (lang, rows) in self.subtitles.items()]), \
+            'audio': dict([(lang, _encode_array(rows)) for (lang, rows) in self.audio.items()])})
+
+    # 'discs' is a list of (path, fingerprint, rows)
+    def _build(self, discs):
+        self.__init__(self.path)
+        for (path, fingerprint, rows) in discs:
+            disc_id = len(self.discs)
+            self.discs.append(path)
+            self.fingerprints.append(fingerprint)
+            for (title, duration, selected, output, subtitles, audio) in rows:
+                row = len(self.outputs)
+                self.columns['disc'].append(disc_id)
+                self.columns['title'].append(title)
+                self.columns['duration'].append(duration)
+                self.columns['selected'].append(selected and 1 or 0)
+                self.outputs.append(output)
+                for lang in set(subtitles):
+                    self.subtitles.setdefault(lang, _sized_array(self.ROW_SIZE)).append(row)
+                for lang in set(audio):
+                    self.audio.setdefault(lang, _sized_array(self.ROW_SIZE)).append(row)
+            self.starts.append(len(self.outputs))
+
+    # Discs that don't have a single title with a track of the language
+    def discs_without(self, index, lang):
+        disc_column = self.columns['disc']
+        having = set([disc_column[row] for row in index.get(lang, [])])
+        return [path for (i, path) in enumerate(self.discs) if i not in having]
+
+    def selected_rows(self):
+        selected = self.columns['selected']
+        return [row for row in xrange(len(selected)) if selected[row]]
+
+    # Selected titles whose output file doesn't exist
+    def unencoded_rows(self):
+        index = OutputIndex()
+        # A title without an output of its own is encoded as another title
+        return [row for row in self.selected_rows() if self.outputs[row] and not index.exists(self.outputs[row])]
+
+    def runtime(self, rows):
+        duration = self.columns['duration']
+        return sum([duration[row] for row in rows])
+
+# An unsigned array of 'size' byte items. The array module only has C type
+# codes, whose sizes depend on the platform.
+def _sized_array(size, values = ()):
+    for code in 'BHIL':
+        if array.array(code).itemsize == size:
+            return array.array(code, values)
+    raise Exception("There's no %d byte array type on this platform" %size)
+
+# Arrays are stored in the catalog as base64 of their raw contents, little
+# endian whatever the machine, since the cache directory can be shared
+def _encode_array(values):
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(values.tostring())
+
+def _decode_array(size, text):
+    values = _sized_array(size)
+    values.fromstring(base64.b64decode(text))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+# The keys of a key -> rows index, by row
+def _rows_by_index(index, count):
+    by_row = [[] for i in xrange(count)]
+    for (key, rows) in index.items():
+        for row in rows:
+            by_row[row].append(key)
+    return by_row
+
+# What's in the output directories. Each directory is listed once per run
+# instead of looking up every output file on its own, since output directories
+# are often network shares where each lookup is a round trip. Files are only
+# stat()ed when their size is needed. Kept up to date as encodes finish, and
+# also notices when two titles are about to be written to the same file.
+class OutputIndex():
+
+    def __init__(self):
+        # Directory -> {name: (size, mtime), or None until it's needed}
+        self.listings = {}
+        # Output -> the title that's going to be written to it
+        self.claims = {}
+
+    def _split(self, path):
+        return os.path.split(os.path.normcase(os.path.abspath(path)))
+
+    def _listing(self, directory):
+        if directory not in self.listings:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                # Doesn't exist (yet)
+                names = []
+            self.listings[directory] = dict([(os.path.normcase(name), None) for name in names])
+        return self.listings[directory]
+
+    def exists(self, path):
+        (directory, name) = self._split(path)
+        return name in self._listing(directory)
+
+    # (size, mtime) of the file, or None when there's no such file
+    def stat(self, path):
+        (directory, name) = self._split(path)
+        listing = self._listing(directory)
+        if name not in listing:
+            return None
+        if listing[name] is None:
+            try:
+                info = os.stat(path)
+            except OSError:
+                del listing[name]
+                return None
+            listing[name] = (info.st_size, int(info.st_mtime))
+        return listing[name]
+
+    # Looks at 'path' again, after it was (or should have been) written
+    def update(self, path):
+        (directory, name) = self._split(path)
+        listing = self._listing(directory)
+        listing[name] = None
+        return self.stat(path)
+
+    # Reserves 'path' for 'owner' (e.g. a disc and title), returning whoever
+    # reserved it first
+    def claim(self, path, owner):
+        return self.claims.setdefault(os.path.normcase(os.path.abspath(path)), owner)
+
+# What each output was encoded from: the source fingerprint and the hash of the
+# encoding settings, by output path. Kept in the cache directory, so outputs
+# whose source or settings changed since can be found and re-encoded. Also
+# keeps the outputs each disc was last planned to produce, so discs that are
+# done don't need to be scanned again.
+class Journal():
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        data = load_json(path, {})
+        self.outputs = data.get('outputs', {})
+        self.discs = data.get('discs', {})
+
+    def get(self, output):
+        return self.outputs.get(os.path.abspath(output))
+
+    # Whether 'output' was encoded from the same source with the same settings,
+    # and is still the file that was written then
+    def is_current(self, output, fingerprint, args_hash):
+        entry = self.get(output)
+        if entry is None or entry['fingerprint'] != fingerprint or entry['args_hash'] != args_hash:
+            return False
+        return self.index.stat(output) == (entry['size'], entry.get('mtime'))
+
+    def record(self, output, source, title, fingerprint, args_hash):
+        (size, mtime) = self.index.update(output)
+        self.outputs[os.path.abspath(output)] = {'source': source, 'title': title, 'fingerprint': fingerprint, \
+                                                 'args_hash': args_hash, 'size': size, 'mtime': mtime}
+        self.save()
+
+    # All of the outputs of the disc, as picked with the settings hashed to
+    # 'settings_hash', exist now
+    def record_disc(self, source, fingerprint, settings_hash, outputs):
+        self.discs[os.path.abspath(source)] = {'fingerprint': fingerprint, 'settings_hash': settings_hash, \
+                                               'outputs': [os.path.abspath(output) for output in outputs]}
+        self.save()
+
+    # The outputs of the disc when it's unchanged, was last picked with the same
+    # settings and all of its outputs are still there (and, with 'strict', are
+    # still encoded from the same source with the same settings). None otherwise.
+    def completed_outputs(self, source, fingerprint, settings_hash, strict):
+        entry = self.discs.get(os.path.abspath(source))
+        if entry is None or fingerprint is None or entry['fingerprint'] != fingerprint \
+                or entry['settings_hash'] != settings_hash:
+            return None
+        for output in entry['outputs']:
+            if strict:
+                title_entry = self.outputs.get(output)
+                if title_entry is None or not self.is_current(output, fingerprint, title_entry['args_hash']):
+                    return None
+            elif not self.index.exists(output):
+                return None
+        return entry['outputs']
+
+    def save(self):
+        save_json(self.path, {'outputs': self.outputs, 'discs': self.discs})
+
+# Identifies the encoding settings of a title: everything HandBrake is told
+# except where the title is read from and written to. Must be calculated before
+# the disc's forced subtitle track is known, like the first title's arguments.
+def calc_args_hash(handbrake_args, settings):
+    options = sorted([(k, v) for (k, v) in handbrake_args.items() if k not in ('input', 'output')])
+    return hashlib.md5(json.dumps([options, settings['passthrough_args'], settings['queue_template']], \
+                                  sort_keys = True)).hexdigest()
+
+# Identifies everything that decides which titles of a disc are encoded to
+# which outputs with which arguments, short of the disc itself
+def calc_settings_hash(settings):
+    keys = ['threshold', 'tv_detection', 'movie_detection', 'auto_detection', 'duplicate_detection', 'min_duration', \
+            'library_duplicates', 'content_hash', 'format', 'native_lang', 'burn_foreign_subs', 'sub_langs', \
+            'audio_passthru', 'audio_langs', 'audio_encoder', 'passthrough_args', 'queue_template']
+    key = [(k, settings.get(k)) for k in keys] + [('output_dir', settings['output_roots'].key())]
+    return hashlib.md5(json.dumps(key, sort_keys = True)).hexdigest()
+
+# The output directories. With more than one (e.g. on different drives), each
+# output goes to one of them as the placement policy says: 'round-robin',
+# 'free-space' (the one with the most space left, counting what this run is
+# going to write there) or 'show' (all discs of a show in the same directory,
+# by a hash of its name). Where each output went is kept in the cache
+# directory, so later runs look for it (and re-encode it) in the same place,
+# whatever the policy would pick now.
+class OutputRoots():
+
+    def __init__(self, roots, policy, path, index):
+        self.roots = [os.path.abspath(root) for root in roots or []]
+        self.policy = policy
+        self.path = path
+        self.index = index
+        # Output file name -> directory
+        self.placed = load_json(path, {})
+        self.turn = 0
+        # Directory -> bytes this run is going to write there
+        self.pending = dict([(root, 0) for root in self.roots])
+
+    # What identifies the directories for the settings hash
+    def key(self):
+        if len(self.roots) == 1:
+            return self.roots[0]
+        return sorted(self.roots)
+
+    # The path to write 'name', one of disc 'disc_name's outputs, to
+    def place(self, disc_name, name, duration):
+        if len(self.roots) == 1:
+            return os.path.join(self.roots[0], name)
+        key = os.path.normcase(name)
+        root = self.placed.get(key)
+        if root not in self.roots:
+            # New, or its directory isn't used anymore. An output that's
+            # already there from before the placements were kept stays put.
+            root = self._existing(name) or self._pick(disc_name)
+            self.placed[key] = root
+            self.pending[root] += duration * ENCODE_BYTES_PER_SECOND
+        return os.path.join(root, name)
+
+    def _existing(self, name):
+        for root in self.roots:
+            if self.index.exists(os.path.join(root, name)):
+                return root
+        return None
+
+    def _pick(self, disc_name):
+        if self.policy == 'show':
+            show = show_name(disc_name)
+            return self.roots[int(hashlib.md5(show.lower()).hexdigest(), 16) % len(self.roots)]
+        if self.policy == 'free-space':
+            free = []
+            for root in self.roots:
+                try:
+                    space = _free_space(root)
+                except OSError:
+                    # Doesn't exist yet
+                    space = None
+                if space is not None:
+                    free.append((space - self.pending[root], root))
+            if free:
+                return max(free)[1]
+            # Can't tell here, e.g. on Windows
+        root = self.roots[self.turn % len(self.roots)]
+        self.turn += 1
+        return root
+
+    # Keeps where the outputs that exist now went, and what was known about
+    # directories that aren't used this run
+    def save(self):
+        if len(self.roots) == 1:
+            return
+        placed = {}
+        for (name, root) in self.placed.items():
+            if root not in self.roots or self.index.exists(os.path.join(root, name)):
+                placed[name] = root
+        save_json(self.path, placed)
+
+# The disc's name without the season and disc numbers at the end. They're
+# taken off one at a time, a single pattern for all of them backtracks
+# exponentially on long runs of digits.
+def show_name(disc_name):
+    name = disc_name
+    while name[-1:].isdigit():
+        shorter = SHOW_SUFFIX.sub('', name).rstrip(' ._-')
+        if not shorter:
+            break
+        name = shorter
+    return name
+
+# Whether the title still needs encoding. An existing output is kept, unless
+# --incremental is on and the journal says it was encoded from a different
+# source or with different settings.
+def needs_encode(output, fingerprint, args_hash, settings):
+    if not settings['output_index'].exists(output):
+        return True
+    journal = settings['journal']
+    if not settings['incremental'] or journal.get(output) is None:
+        logger.warning("Skipping encode because %s already exists!" %output)
+        return False
+    if journal.is_current(output, fingerprint, args_hash):
+        logger.info("Skipping encode because %s is up to date" %output)
+        return False
+    logger.info("Re-encoding %s because its source or encoding settings changed" %output)
+    return True
+
+# --stage-dir support: discs are copied from slow (e.g. network) storage to a
+# local scratch directory and encoded from there. The next disc is copied in
+# the background while the current one encodes, as long as both fit in the
+# space budget, and each copy is removed once its disc is done.
+class Stager():
+
+    def __init__(self, path, budget):
+        # A directory of our own, so whatever an interrupted run left behind
+        # can simply be removed
+        self.path = os.path.join(path, STAGE_SUBDIR)
+        self.budget = budget
+        _remove_path(self.path)
+        os.makedirs(self.path)
+        # The sources with titles to encode, in the order they're encoded
+        self.order = []
+        # Source -> {'thread', 'path' (None until copied, or when it couldn't
+        # be), 'size'}
+        self.copies = {}
+
+    # 'source' has titles to encode, after the sources wanted before it. Only
+    # wanted sources are copied ahead of time.
+    def want(self, source):
+        if source not in self.order:
+            self.order.append(source)
+
+    # The path to encode 'source' from. Waits for its copy (or makes it), and
+    # starts copying the disc after it.
+    def get(self, source):
+        if source not in self.copies and not self._start(source):
+            logger.info("%s doesn't fit in the staging space, encoding it from where it is" %source)
+            self.copies[source] = {'thread': None, 'path': None, 'size': 0}
+        entry = self.copies[source]
+        if entry['thread']:
+            entry['thread'].join()
+        if source in self.order:
+            position = self.order.index(source)
+            if position + 1 < len(self.order) and self.order[position + 1] not in self.copies:
+                self._start(self.order[position + 1])
+        return entry['path'] or source
+
+    def release(self, source):
+        entry = self.copies.pop(source, None)
+        if entry:
+            if entry['thread']:
+                entry['thread'].join()
+            if entry['path']:
+                _remove_path(entry['path'])
+
+    def close(self):
+        for source in self.copies.keys():
+            self.release(source)
+        _remove_path(self.path)
+
+    # Starts copying 'source' in the background, unless it doesn't fit
+    def _start(self, source):
+        size = _path_size(source)
+        used = sum([entry['size'] for entry in self.copies.values()])
+        available = self.budget - used
+        free = _free_space(self.path)
+        if free is not None:
+            available = min(available, free)
+        if size > available:
+            return False
+        entry = {'path': None, 'size': size}
+        entry['thread'] = threading.Thread(target = self._copy, args = (source, entry))
+        entry['thread'].daemon = True
+        self.copies[source] = entry
+        entry['thread'].start()
+        return True
+
+    def _copy(self, source, entry):
+        target = os.path.join(self.path, "%s-%s" %(hashlib.md5(source).hexdigest()[:8], os.path.basename(source.rstrip(os.sep))))
+        partial = target + '.partial'
+        logger.debug("Staging %s to %s" %(source, target))
+        start = time.time()
+        try:
+            if os.path.isdir(source):
+                shutil.copytree(source, partial)
+            else:
+                shutil.copyfile(source, partial)
+            os.rename(partial, target)
+            entry['path'] = target
+            stats.read(entry['size'])
+        except (IOError, OSError, shutil.Error), err:
+            logger.warning("Couldn't stage %s, encoding it from where it is: %s" %(source, err))
+            _remove_path(partial)
+        stats.add('stage', time.time() - start)
+
+def _path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+# Bytes free on the file system of 'path', or None when we can't tell
+def _free_space(path):
+    if not hasattr(os, 'statvfs'):
+        return None
+    info = os.statvfs(path)
+    return info.f_bavail * info.f_frsize
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors = True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+# The titles of the disc that need encoding and their HandBrake arguments, and
+# the outputs of all of its selected titles (None for a title that has nowhere
+# to go), as (titles, jobs, outputs)
+def pick_encodes(disc, encode_settings):
+    titles = []
+    jobs = []
+    outputs = []
     for title in disc.titles:
-        handbrake_args = calc_handbrake_args(disc, title, encode_settings)
-        if os.path.isfile(handbrake_args['output']):
-            logger.warning("Skipping encode because %s already exists!" %handbrake_args['output'])
+        handbrake_args = profiled('planning', calc_handbrake_args, disc, title, encode_settings)
+        args_hash = calc_args_hash(handbrake_args, encode_settings)
+        if not claim_output(handbrake_args['output'], disc.path, title.title, encode_settings):
+            # Never done, the title has nowhere to go
+            outputs.append(None)
+            continue
+        outputs.append(handbrake_args['output'])
+        if needs_encode(handbrake_args['output'], disc.fingerprint, args_hash, encode_settings):
+            title.args_hash = args_hash
+            titles.append(title)
+            jobs.append(handbrake_args)
+    if len(jobs) > 0 and encode_settings.get('stager'):
+        encode_settings['stager'].want(disc.path)
+    return (titles, jobs, outputs)
+
+# Encodes what pick_encodes() picked of the disc
+def encode_disc_with_settings(disc, handbrake, picked, encode_settings):
+    (titles, jobs, outputs) = picked
+    stager = encode_settings.get('stager')
+    if len(jobs) == 0:
+        if stager:
+            stager.release(disc.path)
+        after_moves(encode_settings, record_disc_done, disc, outputs, encode_settings)
+        return
+
+    if stager and not encode_settings['simulate']:
+        source = stager.get(disc.path)
+        try:
+            _encode_jobs(disc, handbrake, titles, jobs, outputs, encode_settings, source)
+        finally:
+            stager.release(disc.path)
+    else:
+        _encode_jobs(disc, handbrake, titles, jobs, outputs, encode_settings, disc.path)
+
+# Encodes the titles of a disc, reading them from 'source' (the disc itself, or
+# a staged copy of it)
+def _encode_jobs(disc, handbrake, titles, jobs, outputs, encode_settings, source):
+    for handbrake_args in jobs:
+        handbrake_args['input'] = source
+
+    template = encode_settings['queue_template']
+    if template:
+        queue_jobs = []
+        for (title, handbrake_args) in zip(titles, jobs):
+            handbrake_args = dict(handbrake_args)
+            handbrake_args['chapters'] = len(title.get('chapters', []))
+            if not encode_settings['simulate']:
+                handbrake_args['output'] = temp_output(handbrake_args['output'], encode_settings)
+            queue_jobs.append(handbrake_args)
+        if encode_settings['simulate']:
+            handbrake.sim_queue(template, queue_jobs)
+        else:
+            start = time.time()
+            result = handbrake.encode_queue(template, queue_jobs, encode_settings['stall_timeout'])
+            stats.add('queue', time.time() - start)
+            failure = queue_failure(result, encode_settings)
+            report_encodes(disc, titles, jobs, queue_jobs, failure, result.jobs_started, encode_settings)
+            if failure:
+                record_failure(disc.path, None, failure)
+            else:
+                after_moves(encode_settings, record_disc_done, disc, outputs, encode_settings)
+        return
 
+    for title in titles:
+        # The forced subtitle track might have been found by the previous encode
+        handbrake_args = profiled('planning', calc_handbrake_args, disc, title, encode_settings)
+        handbrake_args['input'] = source
         if encode_settings['simulate']:
             handbrake.sim(dict_options = handbrake_args, raw_options = encode_settings['passthrough_args'])
         else:
-            handbrake.call(dict_options = handbrake_args, raw_options = encode_settings['passthrough_args'])
+            encode_title(disc, title, handbrake, handbrake_args, encode_settings)
+    if not encode_settings['simulate']:
+        after_moves(encode_settings, record_disc_done, disc, outputs, encode_settings)
+
+# Whether the title can be written to 'output', which it can't when another
+# title of this run is already going to be written there
+def claim_output(output, source, title, encode_settings):
+    (owner_source, owner_title) = encode_settings['output_index'].claim(output, (source, title))
+    if (owner_source, owner_title) != (source, title):
+        record_failure(source, title, "%s is already the output of %s title %s" %(output, owner_source, owner_title))
+        return False
+    return True
+
+# Remembers the outputs of a disc once they're all there, so the next run
+# doesn't need to scan it
+def record_disc_done(disc, outputs, encode_settings):
+    if disc.fingerprint and None not in outputs \
+            and len([o for o in outputs if not encode_settings['output_index'].exists(o)]) == 0:
+        encode_settings['journal'].record_disc(disc.path, disc.fingerprint, calc_settings_hash(encode_settings), outputs)
+
+# Encodes one title, killing and retrying it if it stalls. HandBrake writes to
+# a temporary file, which only becomes the output once the encode succeeded.
+def encode_title(disc, title, handbrake, handbrake_args, encode_settings):
+    search = None
+    watch = None
+    if handbrake_args.get('subtitle-burn') == 'scan':
+        search = SubtitleSearch()
+        watch = search.watch
+    output = handbrake_args['output']
+    temp = temp_output(output, encode_settings)
+    handbrake_args = dict(handbrake_args, output = temp)
+    if not run_encode(handbrake, disc.path, handbrake_args['title'], encode_settings, \
+                      dict_options = handbrake_args, raw_options = encode_settings['passthrough_args'], watch = watch):
+        _remove_path(temp)
+        return False
+    after_moves(encode_settings, finish_encode, temp, output, disc.path, title.title, disc.fingerprint, \
+                title.args_hash, title.duration, title.size(), encode_settings)
+    if search:
+        track = search.forced_track()
+        if track:
+            disc.forced_subtitles[title.subtitle_tracks] = track
+            logger.info("Using subtitle track %s for foreign language parts of titles with the same subtitles as title %s" \
+                %(track, title.title))
+    return True
+
+# Where HandBrake writes 'output' to: a '.partial' file in --temp-dir, or next
+# to the output. The extension stays, HandBrake picks the container by it.
+def temp_output(output, settings):
+    (root, ext) = os.path.splitext(os.path.basename(output))
+    return os.path.join(settings.get('temp_dir') or os.path.dirname(output), root + '.partial' + ext)
+
+# Moves a finished encode to where it belongs and records it
+def finish_encode(temp, output, source, title, fingerprint, args_hash, duration, size, settings):
+    try:
+        _move_file(temp, output)
+    except (IOError, OSError, shutil.Error), err:
+        record_failure(source, title, "Couldn't move %s to %s: %s" %(temp, output, err))
+        return
+    stats.encoded(output, duration, size)
+    settings['journal'].record(output, source, title, fingerprint, args_hash)
+
+# Renames when it can, so the output appears all at once. Otherwise (e.g. from
+# a local temp directory to a network share) copies to a '.partial' file next
+# to the output first and renames that.
+def _move_file(source, target):
+    if os.path.exists(target) and platform.system() == 'Windows':
+        # Windows can't rename over an existing file
+        os.remove(target)
+    try:
+        os.rename(source, target)
+        return
+    except OSError:
+        if not os.path.exists(source):
+            raise
+    (root, ext) = os.path.splitext(target)
+    partial = root + '.partial' + ext
+    shutil.copyfile(source, partial)
+    if os.path.exists(target) and platform.system() == 'Windows':
+        os.remove(target)
+    os.rename(partial, target)
+    os.remove(source)
+
+# Runs function(*args) once the encodes finished so far are where they belong:
+# in the mover's thread after them when there is a mover, or right away
+def after_moves(settings, function, *args):
+    if settings.get('mover'):
+        settings['mover'].submit(function, *args)
+    else:
+        function(*args)
+
+# Moves finished encodes from --temp-dir to their output directory in the
+# background, so the next encode doesn't wait for the copy to a (network)
+# output directory. Runs everything handed to it in order, and everything that
+# touches the journal goes through it. At most 'backlog' tasks wait, after that
+# the next encode waits for the mover instead of filling up the temp directory.
+class Mover():
+
+    def __init__(self, backlog):
+        self.queue = Queue.Queue(backlog)
+        self.thread = threading.Thread(target = self._run)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        self._put((function, args))
+
+    # Waits for everything to be moved
+    def close(self):
+        self._put(None)
+        while self.thread.is_alive():
+            # With a timeout so Ctrl-C still gets through
+            self.thread.join(0.1)
+
+    def _put(self, task):
+        while True:
+            try:
+                self.queue.put(task, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            (function, args) = task
+            try:
+                function(*args)
+            except Exception, err:
+                logger.error("Error after encoding: %s" %err)
+                logger.debug(traceback.format_exc())
+
+# Runs one encode, killing and retrying it if it stalls. Failures are recorded.
+def run_encode(handbrake, source, title, settings, dict_options = None, raw_options = None, watch = None):
+    retries = settings['retries']
+    stall_timeout = settings['stall_timeout']
+    start = time.time()
+    try:
+        for attempt in range(retries + 1):
+            result = handbrake.run(dict_options = dict_options, raw_options = raw_options, \
+                watch = watch, progress = ProgressMonitor(), stall_timeout = stall_timeout)
+            if result.cancelled:
+                return False
+            if result.stalled:
+                logger.warning("Encoding title %s stalled for %s sec, %s" \
+                    %(title, stall_timeout, attempt < retries and 'retrying' or 'giving up'))
+                continue
+            if result.returncode != 0:
+                record_failure(source, title, "HandBrake exited with %s" %result.returncode)
+                return False
+            return True
+        record_failure(source, title, "encode stalled")
+        return False
+    finally:
+        stats.add('encode', time.time() - start)
+
+# The jobs of a disc for an encode plan, with the complete HandBrake CLI
+# arguments (minus the HandBrake CLI path, which depends on the machine)
+def plan_disc(disc, handbrake, encode_settings):
+    jobs = []
+    for title in disc.titles:
+        handbrake_args = calc_handbrake_args(disc, title, encode_settings)
+        args = encode_settings['passthrough_args'] + handbrake.convert_dict_to_args(handbrake_args)
+        jobs.append({'source': disc.path, 'fingerprint': disc.fingerprint, 'title': title['title'], \
+                     'duration': title['duration'], 'size': title.size(), 'args': args, 'output': handbrake_args['output'], \
+                     'args_hash': calc_args_hash(handbrake_args, encode_settings)})
+    return jobs
+
+def write_plan(path, jobs):
+    save_json(path, {'version': PLAN_VERSION, 'jobs': jobs}, indent = 2)
+    logger.info("Wrote %d jobs to %s" %(len(jobs), path))
+
+def load_plan(path):
+    plan = load_json(path, None)
+    if plan is None:
+        raise Exception("Couldn't read the encode plan %s" %path)
+    if plan.get('version') != PLAN_VERSION:
+        raise Exception("%s is a version %s encode plan, expected version %s" %(path, plan.get('version'), PLAN_VERSION))
+    return plan['jobs']
+
+# Part 'shard' (e.g. (1, 3) for the first third) of the jobs. Splits by disc,
+# so all titles of a disc are encoded on the same machine.
+def shard_jobs(jobs, shard):
+    if not shard:
+        return jobs
+    (number, count) = shard
+    sources = []
+    for job in jobs:
+        if job['source'] not in sources:
+            sources.append(job['source'])
+    mine = set([source for (i, source) in enumerate(sources) if i % count == number - 1])
+    return [job for job in jobs if job['source'] in mine]
+
+# Encodes the jobs of a plan without scanning anything. Jobs of a source that
+# changed since the plan was made are skipped. The titles of a disc are encoded
+# one after the other, while the disc is still in the page cache.
+def run_plan(handbrake, jobs, encode_settings):
+    sources = []
+    for job in jobs:
+        if job['source'] not in sources:
+            sources.append(job['source'])
+    jobs = sorted(jobs, key=lambda job: sources.index(job['source']))
+    stager = encode_settings.get('stager')
+    fingerprints = {}
+    runnable = []
+    for job in jobs:
+        source = job['source']
+        if source not in fingerprints:
+            start = time.time()
+            fingerprints[source] = source_fingerprint(source)
+            stats.add('fingerprint', time.time() - start)
+        if job.get('fingerprint') and fingerprints[source] != job['fingerprint']:
+            record_failure(source, job['title'], "the source changed since the plan was made")
+            continue
+        if not claim_output(job['output'], source, job['title'], encode_settings):
+            continue
+        if not needs_encode(job['output'], job.get('fingerprint'), job.get('args_hash'), encode_settings):
+            continue
+        runnable.append(job)
+        if stager:
+            stager.want(source)
+
+    for job in runnable:
+        source = job['source']
+        if stager and not encode_settings['simulate']:
+            # Done with the previous disc
+            for staged in stager.copies.keys():
+                if staged != source and sources.index(staged) < sources.index(source):
+                    stager.release(staged)
+        if encode_settings['simulate']:
+            handbrake.sim(raw_options = job['args'])
+            continue
+        temp = temp_output(job['output'], encode_settings)
+        if run_encode(handbrake, source, job['title'], encode_settings, raw_options = _job_args(job, temp, stager)):
+            after_moves(encode_settings, finish_encode, temp, job['output'], source, job['title'], job.get('fingerprint'), \
+                        job.get('args_hash'), job['duration'], job.get('size'), encode_settings)
+        else:
+            _remove_path(temp)
+
+# The arguments of a plan job, writing to 'temp' and reading from the staged
+# copy of the source
+def _job_args(job, temp, stager):
+    args = list(job['args'])
+    args[args.index('--output') + 1] = temp
+    if stager:
+        args[args.index('--input') + 1] = stager.get(job['source'])
+    return args
+
+# Why the queue didn't finish, or None when it did
+def queue_failure(result, encode_settings):
+    if result.cancelled:
+        return "the queue was cancelled"
+    if result.stalled:
+        return "the queue stalled for %s sec" %encode_settings['stall_timeout']
+    if result.returncode != 0:
+        return "HandBrake exited with %s while encoding the queue" %result.returncode
+    return None
+
+# The queue only tells us how the whole batch went, so check each title's
+# (temporary) output. When the queue didn't finish ('failure'), the job that
+# was running is the last one HandBrake's progress showed starting ('started'
+# jobs), and it and the jobs after it are thrown away. The jobs run one after
+# another, so the ones before it are complete.
+def report_encodes(disc, titles, jobs, queue_jobs, failure, started, encode_settings):
+    finished = len(queue_jobs)
+    if failure:
+        finished = max(started - 1, 0)
+    for (i, (title, handbrake_args, queue_job)) in enumerate(zip(titles, jobs, queue_jobs)):
+        output = handbrake_args['output']
+        temp = queue_job['output']
+        if i >= finished:
+            _remove_path(temp)
+            record_failure(disc.path, handbrake_args['title'], "%s wasn't finished: %s" %(output, failure))
+        elif os.path.isfile(temp) and os.path.getsize(temp) > 0:
+            logger.info("Encoded title %s to %s" %(handbrake_args['title'], output))
+            after_moves(encode_settings, finish_encode, temp, output, disc.path, title.title, disc.fingerprint, \
+                        title.args_hash, title.duration, title.size(), encode_settings)
+        else:
+            _remove_path(temp)
+            record_failure(disc.path, handbrake_args['title'], "%s wasn't written" %output)
+
+def load_queue_template(path):
+    f = open(path)
+    try:
+        queue = json.load(f)
+    finally:
+        f.close()
+    # A queue export is a list of {'Job': {...}}, but a bare job works as well
+    if isinstance(queue, list):
+        if len(queue) == 0:
+            raise Exception("%s doesn't contain any jobs" %path)
+        queue = queue[0]
+    if isinstance(queue, dict):
+        queue = queue.get('Job', queue)
+    # An empty template would quietly encode with the command line settings
+    if not isinstance(queue, dict) or len(queue) == 0:
+        raise Exception("%s doesn't contain a HandBrake queue job" %path)
+    return queue
 
 def calc_handbrake_args(disc, title, settings):
         # Name e.g.: c:\path\2.mkv
-        output_filename = os.path.join(settings['output_dir'],(disc.name + ' - ' + title['title'] + '.' + settings['format'] ))
+        output_filename = settings['output_roots'].place(disc.name, (disc.name + ' - ' + str(title['title']) + '.' + settings['format'] ), \
+                                                         title['duration'])
         
         args = {'input':disc.path, \
                 'output':output_filename, \
@@ -301,7 +2314,15 @@ def calc_handbrake_args(disc, title, settings):
         }
         
         subtitles = []
-        if settings['burn_foreign_subs']:
+        forced_subtitle = settings['burn_foreign_subs'] and disc.forced_subtitle(title)
+        if forced_subtitle:
+            # No need for another foreign audio search pass, it's the first track
+            # in the subtitle list
+            subtitles.append(forced_subtitle)
+            args.update({'subtitle-forced':'1', \
+                        'subtitle-burn':'1', \
+            })
+        elif settings['burn_foreign_subs']:
             subtitles.append('scan')
             args.update({'subtitle-forced':'scan', \
                         'subtitle-burn':'scan', \
@@ -310,30 +2331,132 @@ def calc_handbrake_args(disc, title, settings):
         sub_langs = settings['sub_langs']
         if len(sub_langs) > 0:
             for lang in sub_langs:
-                track = _lowest_match(title['subtitles'], lang)
+                track = title.subtitle_track(lang)
                 if track:
-                    subtitles.append(track)
+                    logger.debug("Found %s language subtitle as track %s" %(lang, track))
+                    subtitles.append(str(track))
+                else:
+                    logger.warning("Didn't find a %s language subtitle track, ignoring\n" %lang)
                 
         if len(subtitles) > 0:
             subtitle_string = ','.join(subtitles)
             args['subtitle'] = subtitle_string
 
+        if settings['audio_passthru']:
+            args.update(calc_audio_args(title, settings))
+
         return args
 
-# Returns the lowest track number that matches the language.
-# There might be multiple tracks of the same language (e.g. director's commentary).
-# Usually the first (lowest number) is the regular subtitles
-def _lowest_match(d, value):
-    tracks = d.keys()
-    tracks.sort()
-    for track in tracks:
-        if d[track] == value:
-            logger.debug("Found %s language subtitle as track %s" %(value, track))
-            return track
-            
-    logger.warning("Didn't find a %s language subtitle track, ignoring\n" %value)
+# Keeps the first track of each wanted language, and copies it as-is when the
+# container can hold its codec instead of re-encoding it
+def calc_audio_args(title, settings):
+    passthru_codecs = PASSTHRU_CODECS.get(settings['format'].lower(), [])
+    tracks = title['audio'].keys()
+    tracks.sort(key=int)
+    audio = []
+    encoders = []
+    for lang in [settings['native_lang']] + settings['audio_langs']:
+        for track in tracks:
+            (track_lang, codec, channels) = title['audio'][track]
+            if track_lang == lang:
+                if track not in audio:
+                    audio.append(track)
+                    if codec in passthru_codecs:
+                        encoders.append('copy:' + codec.lower())
+                    else:
+                        encoders.append(settings['audio_encoder'])
+                break
+        else:
+            logger.warning("Didn't find a %s language audio track, ignoring\n" %lang)
+    if len(audio) == 0:
+        # Leave it up to the encoding settings
+        return {}
+    return {'audio':','.join(audio), 'aencoder':','.join(encoders)}
+
+def get_disc_infos(handbrake, input_dir, index = None, settings = None):
+    return list(iter_disc_infos(handbrake, input_dir, index, settings))
+
+# Yields the discs in order, each as soon as it has been scanned
+def iter_disc_infos(handbrake, input_dir, index = None, settings = None):
+    start = time.time()
+    dirs = profiled('discovery', find_sources, input_dir)
+    end_phase('discovery')
+    stats.add('discovery', time.time() - start)
+
+    scan_options = None
+    if settings:
+        scan_options = calc_scan_options(handbrake, settings)
+    else:
+        settings = {}
+
+    fingerprints = {}
+    for dir in dirs:
+        start = time.time()
+        # Mostly waiting for the disk, which the profile leaves out
+        fingerprints[dir] = source_fingerprint(dir)
+        stats.add('fingerprint', time.time() - start)
+    if settings.get('skip_identical_sources'):
+        dirs = unique_sources(dirs, fingerprints)
+    if settings.get('journal') and not settings.get('rescan'):
+        dirs = skip_completed_sources(dirs, fingerprints, settings)
         
-def get_disc_infos(handbrake, input_dir):
+    # The JSON title set doesn't say which VTS a title is in, which the content
+    # hash needs
+    use_json = handbrake.supports('--json') and not settings.get('content_hash')
+    scan = lambda dir: scan_disc(handbrake, dir, scan_options, settings.get('scan_timeout'), settings.get('retries', 0), use_json)
+    scanned = parallel_imap(scan, dirs, settings.get('scan_jobs', DEFAULT_SCAN_JOBS), \
+                            source_device, settings.get('device_jobs', DEFAULT_DEVICE_JOBS))
+    for (dir, disc) in zip(dirs, scanned):
+        if disc:
+            disc.fingerprint = fingerprints[dir]
+            if index:
+                index.add_disc(disc)
+            yield disc
+
+# Leaves out the sources whose outputs were all encoded by an earlier run with the
+# same settings. Not when looking for titles found on several discs, which
+# needs to see every disc.
+def skip_completed_sources(sources, fingerprints, settings):
+    if settings.get('library_duplicates'):
+        return sources
+    settings_hash = calc_settings_hash(settings)
+    remaining = []
+    for source in sources:
+        outputs = settings['journal'].completed_outputs(source, fingerprints.get(source), settings_hash, settings.get('incremental'))
+        if outputs is None:
+            remaining.append(source)
+        else:
+            logger.info("Skipping %s because its %d titles are already encoded (add --rescan to scan it anyway)" \
+                %(source, len(outputs)))
+    return remaining
+
+# Which drive (or file system) the source is on. Several HandBrake processes
+# reading from the same spinning disk or NAS share just make it seek back and
+# forth, so they're limited per drive.
+def source_device(path):
+    if platform.system() == 'Windows':
+        # No st_dev there, the drive letter (or \\server\share) will do
+        return os.path.splitdrive(os.path.abspath(path))[0].lower()
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+# Scans a disc, retrying it if the scan hangs
+def scan_disc(handbrake, source, scan_options, timeout, retries, use_json = False):
+    start = time.time()
+    try:
+        for attempt in range(retries + 1):
+            try:
+                return handbrake.get_disc_info(source, scan_options, timeout, use_json)
+            except HandbrakeTimeout, err:
+                logger.warning("%s, %s" %(err, attempt < retries and 'retrying' or 'skipping the disc'))
+        record_failure(source, None, "scan timed out")
+        return None
+    finally:
+        stats.add('scan', time.time() - start)
+
+def find_sources(input_dir):
     # Intelligently pick which files/folders to encode just from analyzing the
     # 'root' input folder.
     # If a folder contains any VALID_FOLDER_FILES types of files, it's probably a
@@ -356,13 +2479,26 @@ def get_disc_infos(handbrake, input_dir):
 
     if len(dirs) is 0:
         dirs = [input_dir]
-        
-    discs = []
-    for dir in dirs:
-        disc = handbrake.get_disc_info(dir)
-        if disc:
-            discs.append(disc)
-    return discs
+    return dirs
+
+# HandBrake CLI options that make the title scan cheaper without losing anything
+# the active filters care about
+def calc_scan_options(handbrake, settings):
+    options = {}
+    min_duration = settings['min_duration']
+    if min_duration is None and (settings['movie_detection'] or settings['auto_detection']):
+        # Neither main features nor the episodes auto detection looks for are
+        # that short, so don't bother analysing menus and short extras
+        min_duration = MIN_EPISODE_LENGTH
+    elif min_duration is None and settings['tv_detection']:
+        # Some shows have short episodes, only leave out the menus
+        min_duration = MIN_TITLE_LENGTH
+    if min_duration and handbrake.supports('--min-duration'):
+        options['min-duration'] = min_duration
+    # The previews are only needed when encoding
+    if handbrake.supports('--previews'):
+        options['previews'] = SCAN_PREVIEWS
+    return options
 
 def dvd_file_in_dir(input_dir):
     files = os.listdir(input_dir)
@@ -379,10 +2515,24 @@ def parse_options():
     required_group.add_option('--source-dir', metavar='<dir>', help="Source directory to scan")
     p.add_option_group(required_group)
 
+    plan_group = optparse.OptionGroup(p, "Encode Plan Options")
+    plan_group.add_option('--write-plan', metavar='<file>', help="Write all jobs to an encode plan file instead of encoding")
+    plan_group.add_option('--run-plan', metavar='<file>', help="Encode the jobs of an encode plan file (no --source-dir needed)")
+    plan_group.add_option('--plan-shard', metavar='<i/n>', help="Only run part i of n of the plan, e.g. 1/3 on the first of three machines")
+    p.add_option_group(plan_group)
+
     useful_group = optparse.OptionGroup(p, "Useful Options")
     useful_group.add_option('--encode', action="store_true", help="Actually encode the titles instead of displaying info")
-    useful_group.add_option('--output-dir', metavar='<dir>', help="Destination directory (defaults to the source)")
+    useful_group.add_option('--output-dir', action="append", metavar='<dir>', help="Destination directory (defaults to the source). "\
+        +"Give it more than once to spread the outputs over several directories")
+    useful_group.add_option('--placement', type='choice', choices=PLACEMENT_POLICIES, default=DEFAULT_PLACEMENT, \
+        metavar='<policy>', help="Which of several --output-dirs each output goes to: "+', '.join(PLACEMENT_POLICIES) \
+        +" (default %default)")
+    useful_group.add_option('--incremental', action="store_true", help="Re-encode existing outputs whose source or encoding settings "\
+        +"changed since brakejob encoded them (existing outputs are skipped otherwise)")
     useful_group.add_option('--extension', default = DEFAULT_FORMAT, metavar='(mp4/mkv)', help="The extension to give all encoded videos")
+    useful_group.add_option('--inventory', type='choice', choices=['ndjson'], metavar='ndjson', help="Write one JSON record per disc "\
+        +"and per title to stdout as soon as each disc is scanned (the log goes to stderr)")
     useful_group.add_option('--handbrake-args', default = "", metavar='<"args">', help="All of the encoding arguments to be passed-through "\
         +"to handbrake, surrounded by quotes. (Note that HandBrake CLI only supports built-in presets!)")
     p.add_option_group(useful_group)
@@ -393,11 +2543,45 @@ def parse_options():
     subtitle_group.add_option('--sub-langs', metavar='<lang1,lang2>', help="Comma-separated list of soft subtitle languages to include (e.g. eng,fra)")
     p.add_option_group(subtitle_group)
 
+    audio_group = optparse.OptionGroup(p, "Audio Options")
+    audio_group.add_option('--audio-passthru', action="store_true", help="Only keep the native (and --audio-langs) language audio, "\
+        +"copying tracks the container supports instead of re-encoding them")
+    audio_group.add_option('--audio-langs', metavar='<lang1,lang2>', help="Comma-separated list of other audio languages to keep (e.g. fra,spa)")
+    p.add_option_group(audio_group)
+
     tweak_group = optparse.OptionGroup(p, "Tweaker Options")
     tweak_group.add_option('--handbrake-path', metavar='<path>', help="Path to HandBrake CLI executable")
-    tweak_group.add_option('--threshold', default = DEFAULT_THRESHOLD, metavar='<decimal>', help="Sensitivity threshold for TV episode detection")
+    tweak_group.add_option('--cache-dir', default = DEFAULT_CACHE_DIR, metavar='<dir>', help="Where to keep what brakejob learned between runs "\
+        +"(defaults to %s)" %DEFAULT_CACHE_DIR)
+    tweak_group.add_option('--queue-template', metavar='<file>', help="Encode all titles of a disc with one HandBrake CLI process, "\
+        +"using the encoding settings of a queue exported from HandBrake (replaces --handbrake-args)")
+    tweak_group.add_option('--temp-dir', metavar='<dir>', help="Encode to this (local) directory, and move each finished encode "\
+        +"to the output directory in the background")
+    tweak_group.add_option('--stage-dir', metavar='<dir>', help="Copy each disc to this (local) directory and encode it from there, "\
+        +"copying the next disc while the current one encodes")
+    tweak_group.add_option('--stage-budget', default = DEFAULT_STAGE_BUDGET, type='float', metavar='<GB>', help="Space the staged discs "\
+        +"may take up (defaults to %s GB)" %DEFAULT_STAGE_BUDGET)
+    tweak_group.add_option('--threshold', default = DEFAULT_THRESHOLD, type='float', metavar='<decimal>', help="Sensitivity threshold for TV episode detection")
     tweak_group.add_option('--duplicate-detection', action="store_true", help="Try to filter out duplicate titles")
+    tweak_group.add_option('--scan-jobs', default = DEFAULT_SCAN_JOBS, type='int', metavar='<n>', help="Number of discs to scan at the same time")
+    tweak_group.add_option('--device-jobs', default = DEFAULT_DEVICE_JOBS, type='int', metavar='<n>', help="Number of discs on the same drive "\
+        +"(or network share) to scan at the same time, raise it for SSDs")
+    tweak_group.add_option('--scan-timeout', default = DEFAULT_SCAN_TIMEOUT, type='int', metavar='<sec>', help="Give up scanning a disc after this long (0 to wait forever)")
+    tweak_group.add_option('--stall-timeout', default = DEFAULT_STALL_TIMEOUT, type='int', metavar='<sec>', help="Stop an encode when its progress doesn't move for this long (0 to wait forever)")
+    tweak_group.add_option('--retries', default = DEFAULT_RETRIES, type='int', metavar='<n>', help="Number of times to retry a hung scan or stalled encode")
+    tweak_group.add_option('--min-duration', type='int', metavar='<sec>', help="Don't scan titles shorter than this "\
+        +"(defaults to %s when filtering TV episodes, %s when filtering movies or detecting either)" %(MIN_TITLE_LENGTH, MIN_EPISODE_LENGTH))
+    tweak_group.add_option('--rescan', action="store_true", help="Scan every disc, even those whose titles were all encoded by an earlier run")
+    tweak_group.add_option('--skip-identical-sources', action="store_true", help="Only scan one copy of identical discs (e.g. an iso and its extracted VIDEO_TS folder)")
+    tweak_group.add_option('--library-duplicates', action="store_true", help="Only encode one copy of titles found on several discs")
+    tweak_group.add_option('--content-hash', action="store_true", help="Also compare sampled VOB content when looking for titles found on several discs")
     tweak_group.add_option('--tv-detection', action="store_true", help="Try to only encode TV episodes")
+    tweak_group.add_option('--movie-detection', action="store_true", help="Try to only encode the main feature of movies")
+    tweak_group.add_option('--auto-detection', action="store_true", help="Guess whether each disc is a TV show or a movie and filter it accordingly")
+    tweak_group.add_option('--stats-json', metavar='<file>', help="Also write the run summary (time spent per phase, bytes read and written, "\
+        +"encode speed) to a JSON file")
+    tweak_group.add_option('--profile', metavar='<dir>', help="Profile brakejob itself during source discovery, scan parsing "\
+        +"and planning, writing a pstats file per phase to <dir> and logging the hotspots")
     tweak_group.add_option('--verbose', action="store_true", help="Verbose output")
     p.add_option_group(tweak_group)
     
@@ -406,25 +2590,103 @@ def parse_options():
     if options.verbose:
         logger.setLevel(logging.DEBUG)
     
-    if not options.source_dir:
+    if not options.source_dir and not options.run_plan:
         p.print_help()
         p.error("--source-dir is required")
+
+    if options.plan_shard:
+        try:
+            (number, count) = [int(n) for n in options.plan_shard.split('/')]
+        except ValueError:
+            p.error("--plan-shard must look like 1/3")
+        if not 0 < number <= count:
+            p.error("--plan-shard must look like 1/3")
+        options.plan_shard = (number, count)
+
+    if options.queue_template and (options.write_plan or options.run_plan):
+        # Plan jobs are encoded one title at a time with command line arguments
+        p.error("--queue-template can't be used with --write-plan or --run-plan")
     
-    if not options.output_dir:
-        options.output_dir = options.source_dir
+    if not options.output_dir and options.source_dir:
+        options.output_dir = [options.source_dir]
     
 
 
     return(options, arguments)
 
     
-def get_handbrake_path(given_path):
+def query_main(args):
+    p = optparse.OptionParser(usage = QUERY_USAGE, version="%prog "+VERSION)
+    p.add_option('--cache-dir', default = DEFAULT_CACHE_DIR, metavar='<dir>', help="Where brakejob keeps the catalog "\
+        +"(defaults to %s)" %DEFAULT_CACHE_DIR)
+    p.add_option('--json', action="store_true", help="Answer with one JSON object instead of text")
+    p.add_option('--verbose', action="store_true", help="Verbose output")
+    options, arguments = p.parse_args(args)
+    if options.verbose:
+        logger.setLevel(logging.DEBUG)
+    questions = {'summary': 0, 'missing-subs': 1, 'missing-audio': 1, 'unencoded': 0}
+    if len(arguments) == 0 or arguments[0] not in questions or len(arguments) != questions[arguments[0]] + 1:
+        p.print_help()
+        p.error("Expected one of the questions above")
+
+    start = time.time()
+    catalog = Catalog(os.path.join(options.cache_dir, CATALOG_FILE)).load()
+    if len(catalog.discs) == 0:
+        logger.error("The catalog in %s is empty, it's filled in by scanning discs" %options.cache_dir)
+        sys.exit(1)
+    loaded = time.time()
+
+    question = arguments[0]
+    if question == 'summary':
+        selected = catalog.selected_rows()
+        answer = {'discs': len(catalog.discs), 'titles': len(catalog.outputs), 'selected_titles': len(selected), \
+                  'runtime': catalog.runtime(xrange(len(catalog.outputs))), 'selected_runtime': catalog.runtime(selected)}
+        text = ["%(discs)d discs, %(titles)d titles (%(runtime)d sec), %(selected_titles)d selected (%(selected_runtime)d sec)" %answer]
+    elif question in ('missing-subs', 'missing-audio'):
+        lang = arguments[1]
+        index = question == 'missing-subs' and catalog.subtitles or catalog.audio
+        discs = catalog.discs_without(index, lang)
+        answer = {'lang': lang, 'discs': discs}
+        text = discs + ["%d of %d discs have no %s %s track" %(len(discs), len(catalog.discs), lang, \
+                        question == 'missing-subs' and 'subtitle' or 'audio')]
+    else:
+        rows = catalog.unencoded_rows()
+        titles = [{'disc': catalog.discs[catalog.columns['disc'][row]], 'title': catalog.columns['title'][row], \
+                   'duration': catalog.columns['duration'][row], 'output': catalog.outputs[row]} for row in rows]
+        answer = {'titles': titles, 'runtime': catalog.runtime(rows)}
+        text = ["%(disc)s title %(title)s (%(duration)d sec)" %t for t in titles] \
+            + ["%d titles left to encode, %d sec in total" %(len(titles), answer['runtime'])]
+
+    if options.json:
+        sys.stdout.write(json.dumps(answer) + '\n')
+    else:
+        for line in text:
+            logger.info(line)
+    logger.debug("Loaded the catalog in %.1f ms, answered in %.1f ms" %((loaded - start) * 1000, (time.time() - loaded) * 1000))
+
+def get_handbrake_path(given_path, cache_dir = None):
     (handbrake_exe,handbrake_path) = get_default_platform_handbrake_name_path()
 
     # If a path was provided in the command line, only try that
     if (given_path and os.path.isfile(given_path)):
         return given_path
 
+    # Whatever was found the last time brakejob ran from here
+    cache_file = cache_dir and os.path.join(cache_dir, HANDBRAKE_CACHE)
+    cache = {}
+    if cache_file:
+        cache = load_json(cache_file, {})
+        resolved = cache.get('resolved', {}).get(os.getcwd())
+        if resolved and os.path.isfile(resolved):
+            return resolved
+
+    path = _find_handbrake(handbrake_exe, handbrake_path)
+    if cache_file:
+        cache.setdefault('resolved', {})[os.getcwd()] = path
+        save_json(cache_file, cache)
+    return path
+
+def _find_handbrake(handbrake_exe, handbrake_path):
     # Look in the current directory
     dir = os.path.join(os.getcwd(),handbrake_exe)
     if os.path.isfile(dir):
@@ -446,55 +2708,237 @@ def get_default_platform_handbrake_name_path():
         return ('HandBrakeCLI.exe',os.path.join(os.environ.get('PROGRAMFILES'),'Handbrake'))
     else:
         return ('HandBrakeCLI', '/usr/bin')
+
+def load_json(path, default):
+    if not os.path.isfile(path):
+        return default
+    try:
+        f = open(path)
+        try:
+            return _native_strings(json.load(f))
+        finally:
+            f.close()
+    except (IOError, ValueError), err:
+        logger.warning("Ignoring unreadable %s: %s" %(path, err))
+        return default
+
+# json gives back unicode strings, but paths and arguments need to be plain
+# strings for the file system and the HandBrake CLI
+def _native_strings(value):
+    if isinstance(value, unicode):
+        return value.encode(sys.getfilesystemencoding() or 'utf-8')
+    if isinstance(value, list):
+        return [_native_strings(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(_native_strings(k), _native_strings(v)) for (k, v) in value.items()])
+    return value
+
+# Written to a temporary file first, so an interrupted run can't leave a
+# half-written file behind
+def save_json(path, data, indent = None):
+    dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'w')
+    try:
+        json.dump(data, f, indent = indent)
+    finally:
+        f.close()
+    if os.path.exists(path) and platform.system() == 'Windows':
+        # Windows can't rename over an existing file
+        os.remove(path)
+    os.rename(temp_path, path)
     
+# Waits for the finished encodes to be moved, and cleans up the staged discs
+def close_workers(encode_settings):
+    if encode_settings['mover']:
+        encode_settings['mover'].close()
+    if encode_settings['stager']:
+        encode_settings['stager'].close()
+
 def main():
     options, arguments = parse_options()
+    if options.inventory:
+        # stdout is for the inventory alone
+        supervisor.output = sys.stderr
     
     sub_langs = []
     if options.sub_langs:
         sub_langs = options.sub_langs.split(',')
+
+    audio_langs = []
+    if options.audio_langs:
+        audio_langs = options.audio_langs.split(',')
     
     try:
-        valid_handbrake_path = get_handbrake_path(options.handbrake_path)
+        valid_handbrake_path = get_handbrake_path(options.handbrake_path, options.cache_dir)
     except Exception, err:
         logger.error(err)
         logger.debug(traceback.format_exc())
         sys.exit()
         
+    queue_template = None
+    if options.queue_template:
+        try:
+            queue_template = load_queue_template(options.queue_template)
+        except Exception, err:
+            logger.error("Couldn't read the queue template: %s" %err)
+            logger.debug(traceback.format_exc())
+            sys.exit()
+        if options.handbrake_args:
+            logger.warning("--handbrake-args are ignored for discs encoded with --queue-template")
+
     if not options.encode:
         logger.info("\nINFO MODE: NOTHING WILL BE ENCODED (add --encode to actually encode)\n")
     
     encode_settings = {
                 'input': options.source_dir, \
-                'output_dir': options.output_dir, \
                 'handbrake_path': options.handbrake_path, \
                 'threshold': options.threshold, \
                 'native_lang': options.native_lang, \
                 'burn_foreign_subs': options.burn_foreign_subs, \
                 'sub_langs': sub_langs, \
+                'audio_passthru': options.audio_passthru, \
+                'audio_langs': audio_langs, \
                 'format': options.extension, \
                 'simulate': not options.encode, \
                 'duplicate_detection': options.duplicate_detection, \
                 'tv_detection': options.tv_detection, \
+                'movie_detection': options.movie_detection, \
+                'auto_detection': options.auto_detection, \
+                'scan_jobs': options.scan_jobs, \
+                'device_jobs': options.device_jobs, \
+                'scan_timeout': options.scan_timeout, \
+                'stall_timeout': options.stall_timeout, \
+                'retries': options.retries, \
+                'min_duration': options.min_duration, \
+                'skip_identical_sources': options.skip_identical_sources, \
+                'library_duplicates': options.library_duplicates, \
+                'content_hash': options.content_hash, \
                 'verbose': options.verbose, \
                 'passthrough_args': shlex.split(options.handbrake_args), \
+                'queue_template': queue_template, \
+                'incremental': options.incremental, \
+                'rescan': options.rescan, \
                }
-    handbrake = Handbrake(valid_handbrake_path)
+    encode_settings['output_index'] = OutputIndex()
+    encode_settings['output_roots'] = OutputRoots(options.output_dir, options.placement, \
+        os.path.join(options.cache_dir, PLACEMENT_FILE), encode_settings['output_index'])
+    encode_settings['temp_dir'] = None
+    encode_settings['mover'] = None
+    if options.temp_dir and options.encode:
+        # Ours alone, so what an interrupted run left behind can go
+        encode_settings['temp_dir'] = os.path.join(options.temp_dir, TEMP_SUBDIR)
+        _remove_path(encode_settings['temp_dir'])
+        os.makedirs(encode_settings['temp_dir'])
+        encode_settings['mover'] = Mover(MOVE_BACKLOG)
+    encode_settings['stager'] = None
+    if options.stage_dir and options.encode and not options.write_plan:
+        encode_settings['stager'] = Stager(options.stage_dir, int(options.stage_budget * 1024 ** 3))
+    encode_settings['journal'] = Journal(os.path.join(options.cache_dir, JOURNAL_FILE), encode_settings['output_index'])
+    handbrake = Handbrake(valid_handbrake_path, options.cache_dir)
+    encode_settings['audio_encoder'] = handbrake.aac_encoder()
+    logger.debug("Using HandBrake CLI %s at %s" %(handbrake.capabilities()['version'], valid_handbrake_path))
+    if queue_template and not handbrake.supports('--queue-import-file'):
+        logger.error("This HandBrake CLI can't import queues, --queue-template needs a newer version")
+        sys.exit()
     
+    if options.run_plan:
+        try:
+            jobs = shard_jobs(load_plan(options.run_plan), options.plan_shard)
+        except Exception, err:
+            logger.error(err)
+            logger.debug(traceback.format_exc())
+            sys.exit()
+        logger.info("Running %d jobs of %s\n" %(len(jobs), options.run_plan))
+        try:
+            run_plan(handbrake, jobs, encode_settings)
+        finally:
+            close_workers(encode_settings)
+        report_failures()
+        report_stats(options.stats_json)
+        return
+
+    if options.profile:
+        global profiler
+        if not os.path.isdir(options.profile):
+            os.makedirs(options.profile)
+        profiler = PhaseProfiler(options.profile)
+
     logger.info("Scanning %s for suitable titles to encode" %encode_settings['input'])
-    discs = get_disc_infos(handbrake, encode_settings['input'])
-    
-    if len(discs) > 0:
-        logger.info("Found suitable titles!\n")
-        if not options.encode:
-            logger.info("The following handbrake commands will be run when the --encode option is set:\n")
-    
-    for disc in discs:
-        logger.debug("Found disc: %s\n" %str(disc))
-        encode_disc_with_settings(disc, handbrake, encode_settings)
+    index = None
+    if encode_settings['library_duplicates']:
+        index = TitleIndex(content_hash = encode_settings['content_hash'])
+    catalog = Catalog(os.path.join(options.cache_dir, CATALOG_FILE)).load()
+    # Each disc is filtered and encoded as soon as it's scanned, and then
+    # forgotten about
+    found = False
+    plan = []
+    # The disc to encode next, and what to encode of it
+    waiting = None
+    try:
+        for disc in iter_disc_infos(handbrake, encode_settings['input'], index, encode_settings):
+            if not found:
+                found = True
+                logger.info("Found suitable titles!\n")
+                if not options.encode:
+                    logger.info("The following handbrake commands will be run when the --encode option is set:\n")
+
+            logger.debug("Found disc: %s\n" %str(disc))
+            start = time.time()
+            try:
+                profiled('planning', filter_disc, disc, encode_settings)
+            except Exception, err:
+                record_failure(disc.path, None, err)
+                logger.debug(traceback.format_exc())
+                continue
+            if index:
+                report_library_duplicates(disc, profiled('planning', index.remove_duplicates, disc))
+            stats.add('filter', time.time() - start)
+            if options.inventory == 'ndjson':
+                write_inventory(disc, encode_settings, sys.stdout)
+            if options.write_plan:
+                jobs = profiled('planning', plan_disc, disc, handbrake, encode_settings)
+                plan += jobs
+                catalog.add_disc(disc, dict([(job['title'], job['output']) for job in jobs]))
+            else:
+                # Each disc's titles are picked before the disc ahead of it is
+                # encoded, so it's only staged when it has anything to encode
+                picked = pick_encodes(disc, encode_settings)
+                catalog.add_disc(disc, dict([(title.title, output) for (title, output) in zip(disc.titles, picked[2]) \
+                                             if output]))
+                if waiting:
+                    encode_disc_with_settings(waiting[0], handbrake, waiting[1], encode_settings)
+                waiting = (disc, picked)
+        if waiting:
+            encode_disc_with_settings(waiting[0], handbrake, waiting[1], encode_settings)
+    finally:
+        try:
+            close_workers(encode_settings)
+        finally:
+            # What was learned so far is kept even when the run is stopped
+            catalog.save()
+            encode_settings['output_roots'].save()
+
+    if options.write_plan:
+        write_plan(options.write_plan, plan)
         
+    report_failures()
+    report_stats(options.stats_json)
+    if profiler:
+        profiler.report()
+
     if not options.encode and not options.verbose:
         logger.info("\nWARNING: Some titles might have been purposefully skipped due to filtering. Add --verbose for more details and a listing of any skipped titles and double-check that all desired titles are being encoded.")
         
 if __name__ == "__main__":
-    main()
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'query':
+            query_main(sys.argv[2:])
+        else:
+            main()
+    except KeyboardInterrupt:
+        logger.error("\nInterrupted, stopping HandBrake")
+        supervisor.cancel()
+        sys.exit(1)